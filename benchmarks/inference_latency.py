@@ -0,0 +1,40 @@
+"""Per-call latency of Keras ``predict`` against ``QNetworkInference``.
+
+Run from the repository root:
+
+    python benchmarks/inference_latency.py
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference import QNetworkInference  # noqa: E402
+from main import DeepQNetwork, INPUT_DIMS  # noqa: E402
+
+BATCH_SIZES = (1, 8, 32)
+REPEAT = 50
+
+
+def best_time(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+
+def main():
+    networks = DeepQNetwork(9, input_dimension=INPUT_DIMS)
+    engine = QNetworkInference.from_model(networks.model)
+
+    print('batch  keras predict (ms)  numpy engine (ms)  speedup')
+    for batch_size in BATCH_SIZES:
+        states = np.random.randint(0, 256, size=(batch_size,) + INPUT_DIMS).astype(np.uint8)
+        keras_time = best_time(lambda: networks.predict(states), REPEAT // 5)
+        engine_time = best_time(lambda: engine(states), REPEAT)
+        print('%5d  %18.3f  %17.3f  %6.1fx' % (batch_size, keras_time * 1e3, engine_time * 1e3,
+                                               keras_time / engine_time))
+
+
+if __name__ == '__main__':
+    main()
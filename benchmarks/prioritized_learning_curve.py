@@ -0,0 +1,69 @@
+"""Frames-to-score of uniform against prioritized replay on ``ENV_ID``.
+
+Trains one agent per replay mode for ``MAX_FRAMES`` frames with the
+hyperparameters from ``main.py``, writes every finished episode to
+``learning_curve_<mode>.csv`` as ``frame,score`` and reports the first frame
+at which the mean of the last 20 episodes reaches ``TARGET_SCORE``. Needs
+Gym with the Atari environments. Run from the repository root:
+
+    python benchmarks/prioritized_learning_curve.py [max_frames] [target_score]
+"""
+import os
+import random
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as dqn  # noqa: E402
+from preprocessing import FramePreprocessor  # noqa: E402
+from vec_env import SubprocVecEnv  # noqa: E402
+
+MAX_FRAMES = 2000000
+TARGET_SCORE = 1000
+SEED = 0
+
+
+def frames_to_score(prioritized, max_frames, target_score):
+    random.seed(SEED)
+    np.random.seed(SEED)
+    envs = SubprocVecEnv(dqn.ENV_ID, dqn.NUM_ENVS, FramePreprocessor(dqn.IMG_SIZE), frame_shape=dqn.INPUT_DIMS[1:],
+                         history_length=dqn.INPUT_DIMS[0])
+    agent = dqn.Agent(envs.total_action, learning_rate=dqn.ALPHA,
+                      input_dimension=dqn.INPUT_DIMS, batch_size=dqn.BATCH_SIZE,
+                      discount_factor=dqn.GAMMA, memory_size=dqn.MEMORY_SIZE,
+                      epsilon=dqn.EPSILON, epsilon_decay=dqn.EPSILON_DECAY,
+                      num_envs=dqn.NUM_ENVS, prioritized=prioritized,
+                      priority_alpha=dqn.PRIORITY_ALPHA, priority_beta=dqn.PRIORITY_BETA,
+                      priority_beta_steps=dqn.PRIORITY_BETA_STEPS)
+    filename = 'learning_curve_%s.csv' % ('prioritized' if prioritized else 'uniform')
+
+    loop = dqn.TrainingLoop(agent, envs, replay_ratio=dqn.REPLAY_RATIO, verbose=False)
+    episode_scores = []
+    reached = None
+    loop.reset()
+    while loop.frame_counter < max_frames and reached is None:
+        for env_index, score in loop.step():
+            episode_scores.append(score)
+            dqn.to_csv(filename, [loop.frame_counter, score])
+            if len(episode_scores) >= 20 and np.mean(episode_scores[-20:]) >= target_score:
+                reached = loop.frame_counter
+
+    envs.close()
+    return reached, len(episode_scores)
+
+
+def main():
+    max_frames = int(sys.argv[1]) if len(sys.argv) > 1 else MAX_FRAMES
+    target_score = float(sys.argv[2]) if len(sys.argv) > 2 else TARGET_SCORE
+
+    print('replay        episodes  frames to mean score %g' % target_score)
+    for prioritized in (False, True):
+        reached, episodes = frames_to_score(prioritized, max_frames, target_score)
+        print('%-12s  %8d  %s' % ('prioritized' if prioritized else 'uniform', episodes,
+                                  reached if reached is not None else 'not reached in %d' % max_frames))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Sampling throughput of uniform against prioritized replay.
+
+Fills both memories with ``capacity`` transitions of random episodes and
+times ``sample`` plus, for the prioritized memory, the ``update_priorities``
+call each learner update makes. Run from the repository root:
+
+    python benchmarks/replay_sampling.py [capacity]
+
+The frames stay zero, which does not change the sampling cost; they are
+still allocated, so the default 1,000,000 transitions need about 7 GB of
+address space.
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from replay_memory import PrioritizedReplayMemory, ReplayMemory  # noqa: E402
+
+BATCH_SIZE = 32
+NUM_ENVS = 8
+REPEAT = 200
+
+
+def fill(memory):
+    # Writes the transition arrays directly, one append per slot would take minutes
+    rng = np.random.RandomState(0)
+    memory.actions[:] = rng.randint(0, 9, size=memory.capacity)
+    memory.rewards[:] = rng.randint(-1, 2, size=memory.capacity)
+    memory.terminals[:] = rng.random_sample(memory.capacity) < 1e-3
+    memory.starts[NUM_ENVS:] = memory.terminals[:-NUM_ENVS]
+    memory.starts[:NUM_ENVS] = True
+    memory.index = 0
+    memory.size = memory.capacity
+    memory.appended = memory.capacity
+    if isinstance(memory, PrioritizedReplayMemory):
+        memory.tree.priorities[:] = rng.random_sample(memory.capacity) ** memory.alpha
+        memory.tree.rebuild()
+
+
+def best_time(fn):
+    return min(timeit.repeat(fn, number=REPEAT, repeat=3)) / REPEAT
+
+
+def main():
+    capacity = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    uniform = ReplayMemory(capacity, num_envs=NUM_ENVS)
+    fill(uniform)
+    uniform_time = best_time(lambda: uniform.sample(BATCH_SIZE))
+    del uniform
+
+    prioritized = PrioritizedReplayMemory(capacity, num_envs=NUM_ENVS)
+    fill(prioritized)
+    td_errors = np.random.randn(BATCH_SIZE)
+
+    def prioritized_step():
+        batch = prioritized.sample(BATCH_SIZE, beta=0.4)
+        prioritized.update_priorities(batch['index'], td_errors)
+
+    prioritized_time = best_time(prioritized_step)
+
+    print('capacity %d, batch %d' % (capacity, BATCH_SIZE))
+    print('sampler                 ms/batch  batches/s')
+    for name, seconds in (('uniform', uniform_time), ('prioritized + update', prioritized_time)):
+        print('%-22s  %8.3f  %9.0f' % (name, seconds * 1e3, 1 / seconds))
+
+
+if __name__ == '__main__':
+    main()
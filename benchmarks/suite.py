@@ -0,0 +1,224 @@
+"""Timed benchmarks of the training loop's hot paths, with a baseline check.
+
+Everything runs on ``SyntheticAtariEnv``, so no ROMs or display are needed.
+Each benchmark reports one number: the median milliseconds per call, or
+frames per second for the end-to-end runs. Results are written as JSON;
+with ``--baseline`` every result is compared to a stored run and the exit
+status is 1 if any is more than ``--tolerance`` worse. Run from the
+repository root:
+
+    python benchmarks/suite.py --output bench.json
+    python benchmarks/suite.py --baseline bench.json
+
+Baselines only compare runs on the same machine; store one per CI host.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import numpy as np  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as dqn  # noqa: E402
+from checkpoint import CheckpointManager  # noqa: E402
+from evaluation import AsyncEvaluator  # noqa: E402
+from learner import AsyncLearner  # noqa: E402
+from metrics import Metrics  # noqa: E402
+from preprocessing import FramePreprocessor, FrameStacker  # noqa: E402
+from reporting import EpisodeStatistics  # noqa: E402
+from synthetic_env import SyntheticAtariEnv  # noqa: E402
+from vec_env import SubprocVecEnv  # noqa: E402
+
+SEED = 0
+REPLAY_SIZE = 50000
+REPEAT = 5
+
+
+def median_ms(fn, number):
+    times = timeit.repeat(fn, number=number, repeat=REPEAT)
+    return 1e3 * statistics.median(times) / number
+
+
+def synthetic_frames(n):
+    env = SyntheticAtariEnv(seed=SEED)
+    frames = [env.reset()]
+    frames += [env.step(0)[0] for _ in range(n - 1)]
+    return np.asarray(frames)
+
+
+def preprocessed_frames(n):
+    return FramePreprocessor(dqn.IMG_SIZE)(synthetic_frames(n))
+
+
+def make_agent(prioritized=False, memory_size=REPLAY_SIZE):
+    return dqn.Agent(len(SyntheticAtariEnv().get_action_meanings()), learning_rate=dqn.ALPHA,
+                     input_dimension=dqn.INPUT_DIMS, batch_size=dqn.BATCH_SIZE,
+                     discount_factor=dqn.GAMMA, memory_size=memory_size,
+                     epsilon=0.0, num_envs=dqn.NUM_ENVS, prioritized=prioritized)
+
+
+def fill(agent, frames):
+    states = np.zeros((dqn.NUM_ENVS,) + dqn.INPUT_DIMS, dtype=np.uint8)
+    actions = np.zeros(dqn.NUM_ENVS, dtype=np.int64)
+    rewards = np.zeros(dqn.NUM_ENVS, dtype=np.float32)
+    for i in range(agent.memory.capacity // dqn.NUM_ENVS):
+        states[:, -1] = frames[i % len(frames)]  # same frame for every env
+        dones = np.full(dqn.NUM_ENVS, i % 500 == 499)
+        agent.store_transition(states, actions, rewards, states, dones)
+
+
+def bench_preprocess(results):
+    frames = synthetic_frames(dqn.NUM_ENVS)
+    preprocess = FramePreprocessor(dqn.IMG_SIZE)
+    out = np.empty((dqn.NUM_ENVS,) + dqn.INPUT_DIMS[1:], dtype=np.uint8)
+    results['preprocess'] = median_ms(lambda: preprocess(frames[0], out=out[0]), 200)
+    results['preprocess_batch'] = median_ms(lambda: preprocess(frames, out=out), 50)
+
+    stack = np.zeros(dqn.INPUT_DIMS, dtype=np.uint8)
+    results['shift'] = median_ms(lambda: dqn.shift(stack, out[0]), 1000)
+    stacker = FrameStacker(dqn.NUM_ENVS, dqn.INPUT_DIMS[0], dqn.INPUT_DIMS[1:])
+    results['frame_stacker_push'] = median_ms(lambda: stacker.push(out), 1000)
+
+
+def bench_replay(results, agent):
+    states = np.zeros((dqn.NUM_ENVS,) + dqn.INPUT_DIMS, dtype=np.uint8)
+    actions = np.zeros(dqn.NUM_ENVS, dtype=np.int64)
+    rewards = np.zeros(dqn.NUM_ENVS, dtype=np.float32)
+    dones = np.zeros(dqn.NUM_ENVS, dtype=np.bool_)
+    results['store_transition'] = median_ms(
+        lambda: agent.store_transition(states, actions, rewards, states, dones), 1000)
+    results['sample_exp_batch'] = median_ms(agent.sample_exp_batch, 200)
+
+    prioritized = make_agent(prioritized=True)
+    fill(prioritized, preprocessed_frames(64))
+    results['sample_exp_batch_prioritized'] = median_ms(prioritized.sample_exp_batch, 200)
+
+
+def bench_network(results, agent):
+    batch = agent.sample_exp_batch()
+    networks = agent.networks
+    networks.train(batch, networks.target_model)
+    results['train'] = median_ms(lambda: networks.train(batch, networks.target_model), 10)
+
+    state = batch['state'][0]
+    states = batch['state'][:dqn.NUM_ENVS]
+    results['choose_action'] = median_ms(lambda: agent.choose_action(state), 200)
+    results['choose_actions'] = median_ms(lambda: agent.choose_actions(states), 100)
+
+
+# main.TrainingLoop with what train runs alongside it: metrics, episode
+# statistics, evaluation and checkpoints, each due once within the timed frames
+def bench_end_to_end(results, frames, async_learner=False):
+    agent = make_agent(memory_size=max(2000, frames))
+    agent.epsilon = dqn.EPSILON
+    agent.metrics = Metrics(enabled=dqn.METRICS)
+    learner = AsyncLearner(agent, replay_ratio=dqn.REPLAY_RATIO) if async_learner else None
+    preprocess = FramePreprocessor(dqn.IMG_SIZE)
+    envs = SubprocVecEnv(SyntheticAtariEnv, dqn.NUM_ENVS, preprocess,
+                         frame_shape=dqn.INPUT_DIMS[1:], history_length=dqn.INPUT_DIMS[0])
+    evaluator = AsyncEvaluator(SyntheticAtariEnv, preprocess, input_dims=dqn.INPUT_DIMS,
+                               num_workers=dqn.NUM_EVAL_WORKERS, max_frames=1000)
+    # Scores never count as a new best, so no model files are left behind
+    evaluator.max_mean_score = float('inf')
+    directory = tempfile.mkdtemp(prefix='bench_checkpoints_')
+    checkpoints = CheckpointManager(directory, every_steps=frames // 2)
+    loop = dqn.TrainingLoop(agent, envs, replay_ratio=dqn.REPLAY_RATIO, metrics=agent.metrics,
+                            learner=learner, evaluator=evaluator, evaluate_every=frames // 2,
+                            checkpoints=checkpoints, statistics=EpisodeStatistics(),
+                            train_lock=learner.train_lock if learner is not None else None,
+                            verbose=False)
+    try:
+        loop.reset()
+        first_frame = loop.frame_counter
+        start = time.perf_counter()
+        while loop.frame_counter - first_frame < frames:
+            loop.step()
+        name = 'end_to_end_async_fps' if async_learner else 'end_to_end_fps'
+        results[name] = (loop.frame_counter - first_frame) / (time.perf_counter() - start)
+    finally:
+        envs.close()
+        if learner is not None:
+            learner.close()
+        checkpoints.close()
+        evaluator.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# Only these results are better when higher
+HIGHER_IS_BETTER = ('end_to_end_fps', 'end_to_end_async_fps')
+
+
+def compare(results, baseline, tolerance):
+    failed = []
+    print('%-30s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'change'))
+    for name, value in sorted(results.items()):
+        if name not in baseline:
+            print('%-30s %12s %12.3f' % (name, '-', value))
+            continue
+        old = baseline[name]
+        ratio = old / value if name in HIGHER_IS_BETTER else value / old
+        mark = ''
+        if ratio > 1 + tolerance:
+            failed.append(name)
+            mark = '  SLOWER'
+        print('%-30s %12.3f %12.3f %+7.1f%%%s' % (name, old, value, 100 * (value / old - 1), mark))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline, default 0.2 (20%%)')
+    parser.add_argument('--frames', type=int, default=4000,
+                        help='frames played by the end-to-end benchmark')
+    parser.add_argument('--skip-end-to-end', action='store_true')
+    args = parser.parse_args()
+
+    random.seed(SEED)
+    np.random.seed(SEED)
+    results = {}
+    bench_preprocess(results)
+    agent = make_agent()
+    fill(agent, preprocessed_frames(64))
+    bench_replay(results, agent)
+    bench_network(results, agent)
+    if not args.skip_end_to_end:
+        bench_end_to_end(results, args.frames)
+        bench_end_to_end(results, args.frames, async_learner=True)
+
+    report = {'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                          'processor': platform.processor(), 'cpus': os.cpu_count(),
+                          'numpy': np.__version__},
+              'units': {name: 'frames/s' if name in HIGHER_IS_BETTER else 'ms' for name in results},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        failed = compare(results, baseline, args.tolerance)
+        if failed:
+            print('Slower than the baseline:', ', '.join(failed))
+            sys.exit(1)
+    else:
+        for name, value in sorted(results.items()):
+            print('%-30s %12.3f %s' % (name, value, report['units'][name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Deterministic, Atari-shaped stand-in for the ALE environments.
+
+No ROMs or gym needed. Frames are ``210x160x3`` ``uint8`` images of a
+fixed maze with a few moving sprites, so preprocessing sees realistic
+content, and ``info`` carries ``ale.lives`` like the ALE does. The same
+``seed`` always gives the same frames, rewards and episode ends, whatever
+actions are taken.
+"""
+import numpy as np
+
+HEIGHT, WIDTH = 210, 160
+ACTION_MEANINGS = ['NOOP', 'UP', 'RIGHT', 'LEFT', 'DOWN', 'UPRIGHT', 'UPLEFT', 'DOWNRIGHT', 'DOWNLEFT']
+
+
+class _Space(object):
+    def __init__(self, n=None, shape=None):
+        self.n = n
+        self.shape = shape
+
+
+class SyntheticAtariEnv(object):
+    """Old gym API: ``reset() -> obs`` and ``step(a) -> (obs, reward, done, info)``.
+
+    Every life lasts ``life_length`` steps and an episode ends after ``lives``
+    of them. A reward of 10 is paid every ``reward_every`` steps.
+    """
+
+    def __init__(self, seed=0, lives=3, life_length=300, reward_every=7, num_sprites=5):
+        self.lives = lives
+        self.life_length = life_length
+        self.reward_every = reward_every
+
+        rng = np.random.RandomState(seed)
+        self.background = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+        self.background[:172] = (0, 28, 136)
+        for _ in range(40):
+            y, x = rng.randint(0, 168), rng.randint(0, WIDTH - 16)
+            self.background[y:y + 4, x:x + 16] = (228, 111, 111)
+        self.sprite_colors = rng.randint(64, 256, size=(num_sprites, 3)).astype(np.uint8)
+        self.sprite_starts = rng.randint(0, [172 - 10, WIDTH - 8], size=(num_sprites, 2))
+        self.sprite_speeds = rng.randint(-3, 4, size=(num_sprites, 2))
+
+        self.action_space = _Space(n=len(ACTION_MEANINGS))
+        self.observation_space = _Space(shape=(HEIGHT, WIDTH, 3))
+        self.unwrapped = self
+        self.t = 0
+        self.frame = np.empty((HEIGHT, WIDTH, 3), dtype=np.uint8)
+
+    def get_action_meanings(self):
+        return list(ACTION_MEANINGS)
+
+    def _render(self):
+        self.frame[:] = self.background
+        positions = (self.sprite_starts + self.t * self.sprite_speeds) % [172 - 10, WIDTH - 8]
+        for (y, x), color in zip(positions, self.sprite_colors):
+            self.frame[y:y + 10, x:x + 8] = color
+        return self.frame.copy()
+
+    def reset(self):
+        self.t = 0
+        return self._render()
+
+    def step(self, action):
+        self.t += 1
+        lives = self.lives - self.t // self.life_length
+        reward = 10.0 if self.t % self.reward_every == 0 else 0.0
+        return self._render(), reward, lives <= 0, {'ale.lives': max(lives, 0)}
+
+    def close(self):
+        pass
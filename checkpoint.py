@@ -0,0 +1,254 @@
+import glob
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+import numpy as np
+
+
+def get_optimizer_weights(optimizer):
+    if hasattr(optimizer, 'get_weights'):
+        return optimizer.get_weights()
+    return [np.array(variable) for variable in optimizer.variables]
+
+
+def set_optimizer_weights(model, weights):
+    optimizer = model.optimizer
+    # The slot variables only exist after the first update; create them so
+    # a freshly built model can take the saved state.
+    if hasattr(optimizer, '_create_all_weights'):
+        optimizer._create_all_weights(model.trainable_weights)
+    elif hasattr(optimizer, 'build') and not getattr(optimizer, 'built', True):
+        optimizer.build(model.trainable_weights)
+
+    if len(get_optimizer_weights(optimizer)) != len(weights):
+        print('CheckpointManager: optimizer state does not match the model, not restored')
+        return
+    optimizer.set_weights(weights)
+
+
+def _atomic_write(path, write):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _atomic_savez(path, **arrays):
+    _atomic_write(path, lambda f: np.savez(f, **arrays))
+
+
+# Online (or 'target') network weights of the latest checkpoint, or None
+def load_weights(directory, prefix='model'):
+    path = os.path.join(directory, 'latest.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        files = json.load(f)
+    with np.load(os.path.join(directory, files['checkpoint'])) as data:
+        meta = json.loads(str(data['meta']))
+        return [data['%s_%d' % (prefix, i)] for i in range(meta[prefix + '_count'])]
+
+
+class CheckpointManager(object):
+    """Periodic, asynchronous snapshots of the whole training state.
+
+    ``maybe_save`` is cheap to call every step. Once ``every_steps`` steps or
+    ``every_seconds`` seconds have passed it copies the online and target
+    weights, the optimizer state, epsilon, ``training_count``, the RNG states
+    and the caller's ``counters`` dict, and a background thread writes them
+    to ``directory/checkpoint_<step>.npz``. With ``save_replay`` the replay
+    memory is written to ``replay_<step>.npz`` and ``replay_frames_<step>.npy``
+    as well; its frames are not copied first, so slots appended during the
+    write are dropped again on restore.
+
+    Files are written to a temporary name and renamed into place, and
+    ``latest.json`` only points at a checkpoint once all its files exist, so
+    a run killed mid-write resumes from the previous checkpoint. The last
+    ``keep`` checkpoints are kept. A save that falls due while the previous
+    one is still being written is postponed instead of blocking training.
+    """
+
+    def __init__(self, directory, every_steps=None, every_seconds=None,
+                 save_replay=False, keep=2):
+        if every_steps is None and every_seconds is None:
+            raise ValueError('CheckpointManager: set every_steps or every_seconds')
+        self.directory = directory
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.save_replay = save_replay
+        self.keep = keep
+
+        self.last_step = 0
+        self.last_time = time.time()
+        self.error = None
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def due(self, step):
+        if self.every_steps is not None and step - self.last_step >= self.every_steps:
+            return True
+        return self.every_seconds is not None and time.time() - self.last_time >= self.every_seconds
+
+    @property
+    def busy(self):
+        return self._queue.unfinished_tasks > 0
+
+    # lock, if given, is only taken when a snapshot is actually copied
+    def maybe_save(self, agent, step, counters=None, lock=None):
+        if not self.due(step) or self.busy:
+            return False
+        if lock is None:
+            return self.save(agent, step, counters)
+        with lock:
+            return self.save(agent, step, counters)
+
+    # counters may be a callable, so it is only built when a save is due
+    def save(self, agent, step, counters=None, block=False):
+        if callable(counters):
+            counters = counters()
+        networks = agent.networks
+        snapshot = {
+            'step': step,
+            'model': networks.model.get_weights(),
+            'target': networks.target_model.get_weights(),
+            'optimizer': get_optimizer_weights(networks.model.optimizer),
+            'meta': {'step': step,
+                     'epsilon': agent.epsilon,
+                     'training_count': agent.training_count,
+                     'python_random': random.getstate(),
+                     # Serialized now: the caller keeps appending to its lists
+                     'counters': json.loads(json.dumps(counters or {}))},
+            'numpy_random': np.random.get_state(),
+            'replay': agent.memory.get_state() if self.save_replay else None,
+            'memory': agent.memory,
+        }
+        try:
+            self._queue.put(snapshot, block=block)
+        except queue.Full:
+            return False
+        self.last_step = step
+        self.last_time = time.time()
+        return True
+
+    def _write_loop(self):
+        while True:
+            snapshot = self._queue.get()
+            if snapshot is None:
+                self._queue.task_done()
+                break
+            try:
+                self._write(snapshot)
+            except Exception as e:
+                self.error = e
+                print('CheckpointManager: writing checkpoint', snapshot['step'], 'failed:', e)
+            self._queue.task_done()
+
+    def _write(self, snapshot):
+        step = snapshot['step']
+        meta = dict(snapshot['meta'])
+        files = {'checkpoint': 'checkpoint_%d.npz' % step}
+
+        if snapshot['replay'] is not None:
+            # Frames go to a plain .npy so they can be memory-mapped on restore
+            replay = dict(snapshot['replay'])
+            frames = replay.pop('frames')
+            files['replay_frames'] = 'replay_frames_%d.npy' % step
+            _atomic_write(os.path.join(self.directory, files['replay_frames']),
+                          lambda f: np.save(f, frames))
+            meta['replay_dirty'] = snapshot['memory'].appended - replay['appended']
+            files['replay'] = 'replay_%d.npz' % step
+            _atomic_savez(os.path.join(self.directory, files['replay']), **replay)
+
+        name, keys, pos, has_gauss, cached_gaussian = snapshot['numpy_random']
+        arrays = {'numpy_random_keys': keys,
+                  'numpy_random': np.array([pos, has_gauss, cached_gaussian])}
+        for prefix in ('model', 'target', 'optimizer'):
+            for i, weights in enumerate(snapshot[prefix]):
+                arrays['%s_%d' % (prefix, i)] = weights
+            meta[prefix + '_count'] = len(snapshot[prefix])
+        arrays['meta'] = np.array(json.dumps(meta))
+        _atomic_savez(os.path.join(self.directory, files['checkpoint']), **arrays)
+
+        latest = os.path.join(self.directory, 'latest.json')
+        with open(latest + '.tmp', 'w') as f:
+            json.dump(files, f)
+        os.replace(latest + '.tmp', latest)
+        self._cleanup()
+
+    def _cleanup(self):
+        steps = sorted(int(os.path.basename(path)[len('checkpoint_'):-len('.npz')])
+                       for path in glob.glob(os.path.join(self.directory, 'checkpoint_*.npz')))
+        for step in steps[:-self.keep]:
+            for pattern in ('checkpoint_%d.npz', 'replay_%d.npz', 'replay_frames_%d.npy'):
+                path = os.path.join(self.directory, pattern % step)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # Blocks until every queued checkpoint is on disk
+    def wait(self):
+        self._queue.join()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def latest(self):
+        return self.latest_in(self.directory)
+
+    # The files of the newest complete checkpoint in directory, or None
+    @staticmethod
+    def latest_in(directory):
+        path = os.path.join(directory, 'latest.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def restore(self, agent):
+        """Loads the latest checkpoint into ``agent``, returns its counters or None."""
+        files = self.latest()
+        if files is None:
+            return None
+
+        with np.load(os.path.join(self.directory, files['checkpoint'])) as data:
+            meta = json.loads(str(data['meta']))
+            weights = {prefix: [data['%s_%d' % (prefix, i)] for i in range(meta[prefix + '_count'])]
+                       for prefix in ('model', 'target', 'optimizer')}
+            pos, has_gauss, cached_gaussian = data['numpy_random']
+            np.random.set_state(('MT19937', data['numpy_random_keys'], int(pos),
+                                 int(has_gauss), float(cached_gaussian)))
+
+        networks = agent.networks
+        networks.model.set_weights(weights['model'])
+        networks.target_model.set_weights(weights['target'])
+        if weights['optimizer']:
+            set_optimizer_weights(networks.model, weights['optimizer'])
+        agent.inference_stale = True
+
+        agent.epsilon = meta['epsilon']
+        agent.training_count = meta['training_count']
+        state = meta['python_random']
+        random.setstate((state[0], tuple(state[1]), state[2]))
+
+        if 'replay' in files:
+            with np.load(os.path.join(self.directory, files['replay'])) as replay:
+                state = dict(replay)
+            state['frames'] = np.load(os.path.join(self.directory, files['replay_frames']),
+                                      mmap_mode='r')
+            agent.memory.set_state(state, dirty=meta.get('replay_dirty', 0))
+        # Environments always start new episodes after a restart
+        agent.new_episode[:] = True
+
+        self.last_step = meta['step']
+        self.last_time = time.time()
+        return meta['counters']
@@ -0,0 +1,284 @@
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from replay_memory import ReplayMemory
+
+# One row per environment step, next to the row's frame
+STEP_DTYPE = np.dtype([('action', np.uint8), ('reward', np.float32), ('terminal', np.bool_),
+                       ('start', np.bool_), ('lives', np.uint8)])
+
+
+def _shard_paths(directory, shard):
+    prefix = os.path.join(directory, 'shard_%05d' % shard)
+    return prefix + '_frames.npy', prefix + '_steps.npy'
+
+
+def read_index(directory):
+    with open(os.path.join(directory, 'index.json')) as f:
+        return json.load(f)
+
+
+def _shard_arrays(directory, shard, rows):
+    frames_path, steps_path = _shard_paths(directory, shard)
+    return np.load(frames_path, mmap_mode='r')[:rows], np.load(steps_path, mmap_mode='r')[:rows]
+
+
+def warm_start(memory, directory, limit=None):
+    """Appends the newest ``limit`` recorded rows, by default ``memory.capacity``, to ``memory``."""
+    index = read_index(directory)
+    num_envs = index['num_envs']
+    if memory.num_envs != num_envs or memory.frame_shape != tuple(index['frame_shape']):
+        raise ValueError('warm_start: %s holds %d environments of %s frames'
+                         % (directory, num_envs, tuple(index['frame_shape'])))
+    limit = memory.capacity if limit is None else limit
+    selected = []
+    for shard in range(len(index['shards']) - 1, -1, -1):
+        if limit <= 0:
+            break
+        rows = index['shards'][shard]['rows']
+        first = max(0, rows - limit)
+        selected.append((shard, rows, first - first % num_envs))
+        limit -= rows - first
+
+    # Rows are read through the memory map, one step at a time
+    for shard, rows, first in reversed(selected):
+        frames, steps = _shard_arrays(directory, shard, rows)
+        for i in range(first, rows, num_envs):
+            step = steps[i:i + num_envs]
+            memory.append(frames[i:i + num_envs], step['action'], step['reward'], step['terminal'],
+                          start=step['start'])
+    return len(memory)
+
+
+class TransitionRecorder(object):
+    """Appends every transition of a run to fixed-size shards on disk.
+
+    Rows use the ``ReplayMemory`` layout: the newest frame of the state the
+    agent acted on, the action, the clipped reward, the terminal and episode
+    start flags, and the lives left, with the ``num_envs`` environments
+    interleaved. Each shard of ``shard_size`` rows is a ``uint8`` frames
+    ``.npy`` and a ``STEP_DTYPE`` steps ``.npy``, both written through
+    ``np.memmap``, so recording costs a copy into the page cache per step.
+
+    ``index.json`` lists the shards and their rows, plus ``metadata`` such
+    as the number of actions. It is rewritten atomically when a shard is
+    full, every ``flush_seconds`` and at ``close``, so a killed run loses at
+    most the rows since the last flush. Recording into an existing dataset
+    adds new shards after the old ones.
+    """
+
+    def __init__(self, directory, num_envs=1, frame_shape=(84, 84), shard_size=50000,
+                 flush_seconds=60, metadata=None):
+        self.directory = directory
+        self.num_envs = num_envs
+        self.frame_shape = tuple(frame_shape)
+        self.shard_size = shard_size - shard_size % num_envs
+        self.flush_seconds = flush_seconds
+        self.metadata = dict(metadata or {})
+        os.makedirs(directory, exist_ok=True)
+
+        self.shards = []
+        if os.path.exists(os.path.join(directory, 'index.json')):
+            index = read_index(directory)
+            if index['num_envs'] != num_envs or tuple(index['frame_shape']) != self.frame_shape:
+                raise ValueError('TransitionRecorder: %s holds %d environments of %s frames'
+                                 % (directory, index['num_envs'], tuple(index['frame_shape'])))
+            self.shards = index['shards']
+            self.metadata = dict(index['metadata'], **self.metadata)
+        self.rows = sum(shard['rows'] for shard in self.shards)
+
+        self.new_episode = np.ones(num_envs, dtype=np.bool_)
+        self.last_flush = time.time()
+        self._frames = None
+        self._steps = None
+        self._rows = 0
+
+    def __len__(self):
+        return self.rows
+
+    def _open_shard(self):
+        frames_path, steps_path = _shard_paths(self.directory, len(self.shards))
+        self._frames = np.lib.format.open_memmap(frames_path, mode='w+', dtype=np.uint8,
+                                                 shape=(self.shard_size,) + self.frame_shape)
+        self._steps = np.lib.format.open_memmap(steps_path, mode='w+', dtype=STEP_DTYPE,
+                                                shape=(self.shard_size,))
+        self.shards.append({'name': 'shard_%05d' % len(self.shards), 'rows': 0})
+        self._rows = 0
+
+    # With num_envs > 1 every argument holds one entry per environment
+    def append(self, frame, action, reward, terminate, start=False, lives=0):
+        if self._frames is None:
+            self._open_shard()
+        i, j = self._rows, self._rows + self.num_envs
+        self._frames[i:j] = frame
+        steps = self._steps[i:j]
+        steps['action'] = action
+        steps['reward'] = reward
+        steps['terminal'] = terminate
+        steps['start'] = start
+        steps['lives'] = lives
+        self._rows = j
+        self.rows += self.num_envs
+
+        if j == self.shard_size:
+            self.flush()
+            self._frames = self._steps = None
+        elif time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    # Same arguments as Agent.store_transition, plus the lives of every environment
+    def store_transition(self, state, action, reward, next, terminate, lives=0):
+        self.append(state[:, -1], action, reward, terminate, start=self.new_episode, lives=lives)
+        self.new_episode = np.array(terminate, dtype=np.bool_).reshape(self.num_envs)
+
+    def flush(self):
+        if self._frames is not None:
+            self._frames.flush()
+            self._steps.flush()
+            self.shards[-1]['rows'] = self._rows
+        index = {'num_envs': self.num_envs, 'frame_shape': self.frame_shape,
+                 'shard_size': self.shard_size, 'shards': self.shards, 'metadata': self.metadata}
+        path = os.path.join(self.directory, 'index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.tmp', path)
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self._frames = self._steps = None
+
+
+class TransitionDataset(object):
+    """Samples minibatches from a recorded dataset with bounded memory.
+
+    Up to ``cache_shards`` shards are held in RAM, each as a
+    ``ReplayMemory`` over its arrays, and minibatches are drawn from all of
+    them in proportion to their rows. With more shards than that, a
+    read-ahead thread loads the next ``read_ahead`` shards of a shuffled
+    order in the background; every ``swap_every`` minibatches the least
+    recently loaded shard is replaced by one of them. A swap whose shard is
+    not loaded yet is retried on the next call, so ``sample`` never waits
+    for the disk after the first shards.
+
+    Shards are sampled independently: the first rows of a shard that
+    continue an episode from the previous shard have no history and are
+    never drawn.
+
+    ``sample`` returns the same batches as ``ReplayMemory.sample``, so the
+    dataset can replace ``Agent.memory`` for offline training. ``refresh``
+    picks up shards written since the dataset was opened.
+    """
+
+    def __init__(self, directory, history_length=4, cache_shards=4, read_ahead=1, swap_every=1000):
+        self.directory = directory
+        self.history_length = history_length
+        self.cache_shards = cache_shards
+        self.swap_every = swap_every
+
+        self.shards = []
+        self.refresh()
+        self.total_action = self.metadata.get('total_action')
+        order = self._shuffled()
+        if not order:
+            raise ValueError('TransitionDataset: no usable shards in ' + directory)
+
+        self.batches = 0
+        self._swap_due = False
+        self._cache = collections.OrderedDict()
+        for shard in order[:cache_shards]:
+            self._cache[shard] = self.load(shard)
+
+        self.error = None
+        self._thread = None
+        self._stop = threading.Event()
+        if len(order) > cache_shards:
+            self._loaded = queue.Queue(maxsize=read_ahead)
+            self._thread = threading.Thread(target=self._read_ahead, args=(order[cache_shards:],),
+                                            daemon=True)
+            self._thread.start()
+
+    def __len__(self):
+        return sum(self.shards)
+
+    # Rereads index.json, e.g. while a recorder is still writing the dataset
+    def refresh(self):
+        index = read_index(self.directory)
+        self.num_envs = index['num_envs']
+        self.frame_shape = tuple(index['frame_shape'])
+        self.metadata = index['metadata']
+        self.shards = [shard['rows'] for shard in index['shards']]
+
+    # Shards too short to hold one stacked transition are never sampled
+    def _shuffled(self):
+        shortest = (self.history_length + 1) * self.num_envs
+        return [int(shard) for shard in np.random.permutation(len(self.shards))
+                if self.shards[shard] >= shortest]
+
+    # Reads one shard into memory, sequentially
+    def load(self, shard):
+        frames, steps = (np.array(values) for values in
+                         _shard_arrays(self.directory, shard, self.shards[shard]))
+        return ReplayMemory.from_arrays(frames, steps['action'], steps['reward'], steps['terminal'],
+                                        steps['start'], history_length=self.history_length,
+                                        num_envs=self.num_envs)
+
+    def _read_ahead(self, order):
+        try:
+            self._read_ahead_loop(order)
+        except Exception as e:
+            self.error = e
+
+    def _read_ahead_loop(self, order):
+        while not self._stop.is_set():
+            for shard in order:
+                memory = self.load(shard)
+                while not self._stop.is_set():
+                    try:
+                        self._loaded.put((shard, memory), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if self._stop.is_set():
+                    return
+            order = self._shuffled()
+
+    def _swap(self):
+        try:
+            shard, memory = self._loaded.get_nowait()
+        except queue.Empty:
+            return
+        self._swap_due = False
+        if shard in self._cache:
+            # Reloaded at the start of a new pass; keep it as the newest
+            self._cache.move_to_end(shard)
+            return
+        self._cache.popitem(last=False)
+        self._cache[shard] = memory
+
+    def sample(self, batch_size):
+        self.batches += 1
+        if self.error is not None:
+            raise RuntimeError('TransitionDataset: reading ahead failed') from self.error
+        if self._thread is not None:
+            if self.batches % self.swap_every == 0:
+                self._swap_due = True
+            if self._swap_due:
+                self._swap()
+
+        memories = list(self._cache.values())
+        rows = np.array([len(memory) for memory in memories], dtype=np.float64)
+        counts = np.random.multinomial(batch_size, rows / rows.sum())
+        batches = [memory.sample(n) for memory, n in zip(memories, counts) if n]
+        return {key: np.concatenate([batch[key] for batch in batches]) for key in batches[0]}
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,197 @@
+import multiprocessing
+import queue
+import random
+
+import numpy as np
+
+from inference import QNetworkInference
+from preprocessing import FrameStacker
+from recording import VideoRecorder
+
+
+def run_evaluation(env, preprocess, choose_action, input_dims=(4, 84, 84),
+                   max_frames=10000, max_timestep=5000):
+    """Plays until ``max_frames`` frames have been seen, returns ``[t, score]`` rows."""
+    scores = list()
+    frame_counter = 0
+    stacker = FrameStacker(history_length=input_dims[0], frame_shape=input_dims[1:])
+    obs = np.empty(input_dims[1:], dtype=np.uint8)
+
+    while frame_counter < max_frames:
+        # Initialize the first state with the same 4 images
+        stacker.reset(preprocess(env.reset(), out=obs))
+        frame_counter += 1
+        score = 0
+        t = 0
+        live = 3
+        done = False
+
+        # Start episode
+        while not done or live > 0:
+            action = choose_action(stacker.stacked)
+            observation, reward, done, info = env.step(action)
+            live = info['ale.lives']
+            stacker.push(preprocess(observation, out=obs))
+            score += reward
+            t += 1
+            frame_counter += 1
+
+            # End episode
+            if done or live < 1 or t > max_timestep:
+                scores.append([t, score])
+                break
+
+    return np.asarray(scores)
+
+
+def best_episode(scores):
+    max_indices = np.argwhere(scores[:, 1] == np.max(scores[:, 1])).ravel()
+    return scores[np.random.choice(max_indices), :].ravel()
+
+
+# Keras is only loaded by a worker once it has a new best model to save
+def _save_weights(json_config, weights, filename):
+    from keras.models import model_from_json
+
+    model = model_from_json(json_config)
+    model.set_weights(weights)
+    model.save_weights(filename)
+
+
+def _evaluation_worker(tasks, results, env_id, preprocess, input_dims, max_frames,
+                       max_mean_score, lock, video):
+    if callable(env_id):
+        env = env_id()
+    else:
+        import gym
+        env = gym.make(env_id)
+    if video is not None:
+        env = VideoRecorder(env, **video)
+    network = None
+    model_json = None
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        frame_counter, episode_counter, json_config, weights = task
+
+        # Every task posts a result, so the evaluator's pending count stays right
+        try:
+            # Rebuild the network only when the architecture changes
+            if json_config != model_json:
+                network = QNetworkInference.from_json(json_config, weights)
+                model_json = json_config
+            else:
+                network.set_weights(weights)
+            total_action = len(weights[-1])
+
+            def choose_action(state):
+                if random.random() <= 0.05:
+                    return np.random.choice(total_action)
+                return np.argmax(network(state))
+
+            scores = run_evaluation(env, preprocess, choose_action, input_dims=input_dims,
+                                    max_frames=max_frames)
+
+            # Save best model
+            with lock:
+                if max_mean_score.value < np.mean(scores):
+                    max_mean_score.value = np.mean(scores)
+                    _save_weights(json_config, weights,
+                                  str(scores[len(scores) - 1]) + '_best.weights.h5')
+
+            t, score = best_episode(scores)
+            results.put((frame_counter, episode_counter, t, score, None))
+        except Exception as e:
+            results.put((frame_counter, episode_counter, None, None, repr(e)))
+
+    env.close()
+
+
+class AsyncEvaluator(object):
+    """Evaluates weight snapshots in worker processes, off the training loop.
+
+    ``submit`` copies the online network's weights and returns immediately.
+    Every worker keeps one environment and one ``QNetworkInference`` for its
+    whole life, so it plays without Keras. The best mean score is shared
+    between workers, which save ``*_best.weights.h5`` themselves. Finished evaluations are
+    collected with ``poll`` as ``(frame_counter, episode_counter, t, score)`` tuples; an
+    evaluation that failed in its worker is printed and left out.
+
+    ``video`` holds ``VideoRecorder`` keyword arguments to record evaluation
+    episodes; every worker then writes its own videos.
+
+    At most ``max_pending`` snapshots wait in the queue; further submissions
+    are dropped rather than delaying training.
+    """
+
+    def __init__(self, env_id, preprocess, input_dims=(4, 84, 84), num_workers=1,
+                 max_frames=10000, max_pending=None, video=None):
+        ctx = multiprocessing.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self._max_mean_score = ctx.Value('d', 0.0)
+        self.max_pending = 2 * num_workers if max_pending is None else max_pending
+        self.pending = 0
+
+        self._lock = ctx.Lock()
+        self.processes = []
+        for _ in range(num_workers):
+            process = ctx.Process(target=_evaluation_worker,
+                                  args=(self.tasks, self.results, env_id, preprocess,
+                                        input_dims, max_frames, self._max_mean_score, self._lock,
+                                        video),
+                                  daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    @property
+    def max_mean_score(self):
+        return self._max_mean_score.value
+
+    @max_mean_score.setter
+    def max_mean_score(self, value):
+        self._max_mean_score.value = value
+
+    def submit(self, model, frame_counter, episode_counter):
+        if self.pending >= self.max_pending:
+            print('Evaluation skipped at frame', frame_counter, '-', self.pending, 'still pending')
+            return False
+        self.tasks.put((frame_counter, episode_counter, model.to_json(), model.get_weights()))
+        self.pending += 1
+        return True
+
+    # With block, waits for every pending evaluation while a worker is alive
+    def poll(self, block=False):
+        finished = []
+        while self.pending > 0:
+            try:
+                result = self.results.get(timeout=1.0) if block else self.results.get_nowait()
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.processes):
+                    print('AsyncEvaluator: every worker has exited,', self.pending,
+                          'evaluations lost')
+                    self.pending = 0
+                if block and self.pending > 0:
+                    continue
+                break
+            self.pending -= 1
+            frame_counter, episode_counter, t, score, error = result
+            if error is not None:
+                print('AsyncEvaluator: evaluation at frame', frame_counter, 'failed:', error)
+                continue
+            finished.append((frame_counter, episode_counter, t, score))
+        return finished
+
+    # Waits for the pending evaluations and stops the workers
+    def close(self, timeout=60):
+        finished = self.poll(block=True)
+        for process in self.processes:
+            if process.is_alive():
+                self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        return finished
@@ -0,0 +1,128 @@
+import json
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0, out=x),
+}
+
+
+def _windows(x, kernel_size, strides):
+    # (B, H, W, C) -> (B, OH, OW, kh, kw, C) view of every receptive field
+    batch, height, width, channels = x.shape
+    kh, kw = kernel_size
+    sh, sw = strides
+    out_h = (height - kh) // sh + 1
+    out_w = (width - kw) // sw + 1
+    sb, s_h, s_w, sc = x.strides
+    return as_strided(x, shape=(batch, out_h, out_w, kh, kw, channels),
+                      strides=(sb, s_h * sh, s_w * sw, s_h, s_w, sc), writeable=False)
+
+
+class QNetworkInference(object):
+    """NumPy forward pass of the Q-network built by ``DeepQNetwork.build_network``.
+
+    Supports sequential models of ``valid``-padded ``Conv2D``, ``Flatten`` and
+    ``Dense`` layers with ``relu`` or linear activations. Activations are kept
+    channels-last internally; a channels-first input is transposed once and
+    the first ``Dense`` kernel is permuted at sync time, so no transposes run
+    between layers. States can be passed as ``uint8`` stacks of any batch size.
+
+    The weights are a copy: call ``sync`` after training to pick up new ones.
+    """
+
+    def __init__(self, layers, weights=None):
+        self.layers = []
+        for class_name, config in layers:
+            if class_name in ('InputLayer', 'Dropout'):
+                continue
+            if class_name not in ('Conv2D', 'Flatten', 'Dense'):
+                raise ValueError('QNetworkInference: unsupported layer ' + class_name)
+            if class_name == 'Conv2D' and config.get('padding', 'valid') != 'valid':
+                raise ValueError('QNetworkInference: only valid padding is supported')
+            self.layers.append((class_name, config))
+        self.params = []
+        if weights is not None:
+            self.set_weights(weights)
+
+    @classmethod
+    def from_model(cls, model):
+        layers = [(layer.__class__.__name__, layer.get_config()) for layer in model.layers]
+        return cls(layers, model.get_weights())
+
+    # Build from model.to_json() and model.get_weights(), without Keras
+    @classmethod
+    def from_json(cls, json_config, weights):
+        config = json.loads(json_config)['config']
+        layers = config['layers'] if isinstance(config, dict) else config
+        return cls([(layer['class_name'], layer['config']) for layer in layers], weights)
+
+    @property
+    def channels_first(self):
+        for class_name, config in self.layers:
+            if class_name == 'Conv2D':
+                return config.get('data_format') == 'channels_first'
+        return False
+
+    def sync(self, model):
+        self.set_weights(model.get_weights())
+
+    def set_weights(self, weights):
+        weights = iter(weights)
+        params = []
+        conv_shape = None
+        for class_name, config in self.layers:
+            if class_name == 'Conv2D':
+                kernel = np.asarray(next(weights), dtype=np.float32)
+                bias = np.asarray(next(weights), dtype=np.float32) if config.get('use_bias', True) else None
+                params.append((kernel.reshape(-1, kernel.shape[-1]), bias))
+                conv_shape = config
+            elif class_name == 'Dense':
+                kernel = np.asarray(next(weights), dtype=np.float32)
+                bias = np.asarray(next(weights), dtype=np.float32) if config.get('use_bias', True) else None
+                if conv_shape is not None and conv_shape.get('data_format') == 'channels_first':
+                    # Rows are ordered (C, H, W) by Flatten; reorder them to
+                    # match the channels-last activations.
+                    channels = conv_shape['filters']
+                    spatial = kernel.shape[0] // channels
+                    kernel = kernel.reshape(channels, spatial, -1).transpose(1, 0, 2).reshape(kernel.shape)
+                conv_shape = None
+                params.append((np.ascontiguousarray(kernel), bias))
+            else:
+                # A channels_first Flatten already emits (H, W, C) order
+                if config.get('data_format') == 'channels_first':
+                    conv_shape = None
+                params.append(None)
+        self.params = params
+
+    def __call__(self, states):
+        x = np.asarray(states)
+        if x.ndim == 3:
+            x = x[np.newaxis]
+        if self.channels_first:
+            x = x.transpose(0, 2, 3, 1)
+        x = x.astype(np.float32)
+
+        for (class_name, config), param in zip(self.layers, self.params):
+            if class_name == 'Conv2D':
+                kernel, bias = param
+                windows = _windows(x, config['kernel_size'], config['strides'])
+                out_shape = windows.shape[:3]
+                x = np.matmul(windows.reshape(-1, kernel.shape[0]), kernel)
+                if bias is not None:
+                    x += bias
+                x = ACTIVATIONS[config.get('activation', 'linear')](x).reshape(out_shape + (-1,))
+            elif class_name == 'Flatten':
+                x = x.reshape(len(x), -1)
+            else:
+                kernel, bias = param
+                x = np.matmul(x, kernel)
+                if bias is not None:
+                    x += bias
+                x = ACTIVATIONS[config.get('activation', 'linear')](x)
+        return x
+
+    def predict(self, states):
+        return self(states)
@@ -0,0 +1,145 @@
+import queue
+import threading
+
+
+class AsyncLearner(object):
+    """Trains ``agent`` in a background thread while the actors keep playing.
+
+    A prefetch thread samples minibatches into a queue of ``prefetch``
+    batches, so one is always assembled while the previous one trains. The
+    learner thread performs ``replay_ratio`` updates per frame passed to
+    ``observe``, counted once the memory holds ``learn_start`` transitions,
+    which keeps the updates per frame of the synchronous loop. When it falls
+    more than ``max_lag`` updates behind, ``observe`` waits for it instead of
+    letting the actors run ahead.
+
+    Every ``target_sync`` updates the target network is synced and epsilon
+    decayed, as in the synchronous loop. Every ``acting_sync`` updates the
+    learner publishes its weights, and ``observe`` loads them into the
+    agent's NumPy inference copy on the acting thread.
+
+    Transitions must be stored through ``store_transition``. Hold
+    ``train_lock`` to read the networks or optimizer consistently, e.g. for
+    checkpoints and evaluation snapshots. An error in either thread is
+    raised again by the next ``observe`` or ``close``.
+    """
+
+    def __init__(self, agent, replay_ratio=0.25, learn_start=1000, prefetch=2,
+                 target_sync=10000, acting_sync=10, max_lag=16):
+        self.agent = agent
+        self.replay_ratio = replay_ratio
+        self.learn_start = learn_start
+        self.target_sync = target_sync
+        self.acting_sync = acting_sync
+        self.max_lag = max_lag
+
+        self.frames = 0
+        self.updates = 0
+        self.error = None
+
+        self.memory_lock = threading.Lock()
+        self.train_lock = threading.Lock()
+        self._progress = threading.Condition()
+        self._stop = threading.Event()
+        self._batches = queue.Queue(maxsize=prefetch)
+        self._acting_weights = None
+
+        self._threads = [threading.Thread(target=self._run, args=(loop,), daemon=True)
+                         for loop in (self._prefetch_loop, self._train_loop)]
+        for thread in self._threads:
+            thread.start()
+
+    # Updates owed to the frames observed so far
+    @property
+    def due(self):
+        return int(self.frames * self.replay_ratio) - self.updates
+
+    def store_transition(self, state, action, reward, next, terminate):
+        with self.memory_lock:
+            self.agent.store_transition(state, action, reward, next, terminate)
+
+    def observe(self, frames):
+        self._check()
+        if len(self.agent.memory) >= self.learn_start:
+            with self._progress:
+                self.frames += frames
+                self._progress.notify_all()
+                while self.due > self.max_lag and self.error is None and not self._stop.is_set():
+                    self._progress.wait(0.1)
+            self._check()
+        self.refresh_acting()
+
+    # Loads the latest published weights into the acting network
+    def refresh_acting(self):
+        with self._progress:
+            weights, self._acting_weights = self._acting_weights, None
+        if weights is not None:
+            self.agent.inference.set_weights(weights)
+            self.agent.inference_stale = False
+
+    def _run(self, loop):
+        try:
+            loop()
+        except Exception as e:
+            self.error = e
+            self._stop.set()
+            with self._progress:
+                self._progress.notify_all()
+
+    def _prefetch_loop(self):
+        agent = self.agent
+        while not self._stop.is_set():
+            if len(agent.memory) < self.learn_start:
+                self._stop.wait(0.01)
+                continue
+            with self.memory_lock:
+                with agent.metrics.timer('replay_sample'):
+                    batch = agent.sample_exp_batch()
+            while not self._stop.is_set():
+                try:
+                    self._batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def _train_loop(self):
+        agent = self.agent
+        networks = agent.networks
+        while not self._stop.is_set():
+            with self._progress:
+                if self.due <= 0:
+                    self._progress.wait(0.1)
+                    continue
+            try:
+                batch = self._batches.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            with self.train_lock:
+                agent.train_batch(batch)
+                if agent.training_count % self.target_sync == 0:
+                    networks.target_model.set_weights(networks.model.get_weights())
+                    agent.update_epsilon()
+                weights = networks.model.get_weights() \
+                    if agent.training_count % self.acting_sync == 0 else None
+            with self.memory_lock:
+                agent.update_priorities(batch)
+
+            with self._progress:
+                self.updates += 1
+                if weights is not None:
+                    self._acting_weights = weights
+                self._progress.notify_all()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError('AsyncLearner: learner thread failed') from self.error
+
+    # Stops both threads; updates still owed are dropped
+    def close(self):
+        self._stop.set()
+        with self._progress:
+            self._progress.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._check()
@@ -16,15 +16,17 @@ Original file is located at
 # !pip install pyvirtualdisplay
 # !pip install piglet
 
-from keras.optimizers import RMSprop
-from keras.models import Sequential
-from keras.layers import Dense, Conv2D, Flatten
-from keras.initializers import VarianceScaling
-from random import random, randrange
+# Keras and gym are imported where they are used, so the command line and
+# the helper modules load without them
+import argparse
+import contextlib
+import json
+import os
 import random
+import signal
+import sys
 
-import gym
-import matplotlib.pyplot as plt
+import numpy as np
 
 # from stable_baselines.common.policies import MlpPolicy
 # from stable_baselines.common.vec_env import VecVideoRecorder, SubprocVecEnv, DummyVecEnv
@@ -34,15 +36,21 @@ import matplotlib.pyplot as plt
 # drive.mount('/content/drive')
 #
 
-from keras.callbacks import *
 # !ls /content/drive/'My Drive'/'Colab Notebooks'/
 
-
-from PIL import Image
+from checkpoint import CheckpointManager, load_weights
+from dataset import TransitionDataset, TransitionRecorder, warm_start
+from evaluation import AsyncEvaluator, best_episode, run_evaluation
+from inference import QNetworkInference
+from learner import AsyncLearner
+from metrics import Metrics
+from preprocessing import FramePreprocessor
+from replay_memory import PrioritizedReplayMemory, ReplayMemory
+from reporting import EpisodeStatistics, ReportRenderer
+from vec_env import SubprocVecEnv
 # from pyvirtualdisplay import Display
 # from IPython import display as ipythondisplay
 # from IPython.display import clear_output
-from gym.wrappers import Monitor
 
 # display = Display(visible=0, size=(1400, 900))
 # display.start()
@@ -81,7 +89,7 @@ class DeepQNetwork(object):
     def __init__(self, total_action, learning_rate=0.00025,
                  input_dimension=(210, 160, 4),
                  batch_size=32, discount_factor=0.99,
-                 load_path=None):
+                 load_path=None, per_sample_targets=False):
 
         # Parameters
         self.total_action = total_action
@@ -90,9 +98,12 @@ class DeepQNetwork(object):
         self.discount_factor = discount_factor
         self.input_dimension = input_dimension
         self.load_path = load_path
-        self.checkpoint = ModelCheckpoint("checkpoint_0.025_1_280220.h5", monitor='val_acc', save_weights_only=True)
+        # Reference mode: build targets with one predict call per experience
+        self.per_sample_targets = per_sample_targets
+        self.td_errors = None
+        # Checkpoints are written by CheckpointManager, outside training
         # tensorboard = TensorBoard(log_dir="logs/{}".format(time()))
-        self.callbacks_list = [self.checkpoint]
+        self.callbacks_list = []
 
         # Init DQN
         self.model = self.build_network()
@@ -102,6 +113,11 @@ class DeepQNetwork(object):
             self.model.load_weights(self.load_path)
 
     def build_network(self):
+        from keras.initializers import VarianceScaling
+        from keras.layers import Conv2D, Dense, Flatten
+        from keras.models import Sequential
+        from keras.optimizers import RMSprop
+
         # CNN
         model = Sequential()
         model.add(Conv2D(32,
@@ -142,36 +158,65 @@ class DeepQNetwork(object):
         return model
 
     def train(self, batch, target):
-        s_train, q_train, train_result = [], [], []
+        if self.per_sample_targets:
+            s_train, q_train, td_errors = self.per_sample_q_targets(batch, target)
+        else:
+            s_train, q_train, td_errors = self.q_targets(batch, target)
+        # Read back by the agent to update prioritized replay
+        self.td_errors = td_errors
+
+        # One gradient step on the whole batch; fit adds per-call setup and a
+        # progress bar. Importance-sampling weights are present when the batch is prioritized
+        train_result = self.model.train_on_batch(s_train, q_train, sample_weight=batch.get('weight'))
+        # to_csv("history.csv", train_result)
+
+        return train_result
+
+    # Bellman targets for the whole batch, one forward pass per network
+    def q_targets(self, batch, target):
+        s_train = batch['state'].astype(np.float32)
+        next_state = batch['next'].astype(np.float32)
+        batch_size = len(s_train)
+
+        q_train = np.array(self.model.predict_on_batch(s_train), dtype=np.float32)
+        next_q = np.max(target.predict_on_batch(next_state), axis=1)
+
+        not_terminal = ~np.asarray(batch['terminate'], dtype=np.bool_)
+        rewards = np.asarray(batch['reward'], dtype=np.float32)
+        rows = np.arange(batch_size)
+        q_target = rewards + not_terminal * np.float32(self.discount_factor) * next_q
+        td_errors = q_target - q_train[rows, batch['action']]
+        q_train[rows, batch['action']] = q_target
+        return s_train, q_train, td_errors
+
+    # Reference implementation of q_targets, kept to validate the batched path
+    def per_sample_q_targets(self, batch, target):
+        s_train, q_train, td_errors = [], [], []
 
-        # Main Algorithm
-        for experience in batch:
-            s_train.append(experience['state'].astype(np.float64))
+        for i in range(len(batch['action'])):
+            state = batch['state'][i:i + 1]
+            s_train.append(state.astype(np.float32))
 
-            next_state = experience['next'].astype(np.float64)
+            next_state = batch['next'][i:i + 1].astype(np.float32)
             next_state_predict = target.predict(next_state).ravel()
             next_q = np.max(next_state_predict)
 
-            q_list = list(self.predict(experience['state'])[0])
-            if not experience['terminate']:
-                q_list[experience['action']] = experience['reward'] + self.discount_factor * next_q
+            q_list = list(self.predict(state)[0])
+            q_old = q_list[batch['action'][i]]
+            if not batch['terminate'][i]:
+                q_list[batch['action'][i]] = batch['reward'][i] + np.float32(self.discount_factor) * next_q
             else:
-                q_list[experience['action']] = experience['reward']
+                q_list[batch['action'][i]] = batch['reward'][i]
+            td_errors.append(q_list[batch['action'][i]] - q_old)
             q_train.append(q_list)
 
-        s_train = np.asarray(s_train).squeeze()
-        q_train = np.asarray(q_train).squeeze()
-
-        train_result = self.model.fit(s_train, q_train,
-                       batch_size=self.batch_size, epochs=1,
-                       verbose=0, callbacks=self.callbacks_list)
-        # to_csv("history.csv", [train_result.history['loss'][0], train_result.history['acc'][0]])
-
-        return train_result
+        s_train = np.concatenate(s_train)
+        q_train = np.asarray(q_train, dtype=np.float32)
+        return s_train, q_train, np.asarray(td_errors, dtype=np.float32)
 
     def predict(self, state):
         state = state.astype(np.float64)
-        return self.model.predict(state, batch_size=1)
+        return self.model.predict(state, batch_size=len(state))
 
 
 class Agent(object):
@@ -179,7 +224,10 @@ class Agent(object):
                  learning_rate=0.00025, input_dimension=(210, 160, 4),
                  batch_size=32, discount_factor=0.99,
                  memory_size=1024, epsilon=1,
-                 epsilon_decay=0.99, load_path=None):
+                 epsilon_decay=0.99, load_path=None, num_envs=1,
+                 prioritized=False, priority_alpha=0.6, priority_beta=0.4,
+                 priority_beta_steps=250000, metrics=None, per_sample_targets=False,
+                 replay_dir=None):
         # Hyper parameters
         self.total_action = total_action
         self.learning_rate = learning_rate
@@ -192,8 +240,26 @@ class Agent(object):
         # Initialize memory
         self.batch_size = batch_size
         self.memory_size = memory_size
-        self.memory = []
+        self.num_envs = num_envs
+        self.prioritized = prioritized
+        # Replay frames memory-mapped from replay_dir, so they can exceed RAM
+        frames_path = None
+        if replay_dir is not None:
+            os.makedirs(replay_dir, exist_ok=True)
+            frames_path = os.path.join(replay_dir, 'replay_frames.npy')
+        if self.prioritized:
+            self.memory = PrioritizedReplayMemory(self.memory_size, frame_shape=self.input_dimension[1:],
+                                                  history_length=self.input_dimension[0],
+                                                  num_envs=self.num_envs, alpha=priority_alpha,
+                                                  beta=priority_beta, beta_steps=priority_beta_steps,
+                                                  frames_path=frames_path)
+        else:
+            self.memory = ReplayMemory(self.memory_size, frame_shape=self.input_dimension[1:],
+                                       history_length=self.input_dimension[0], num_envs=self.num_envs,
+                                       frames_path=frames_path)
+        self.new_episode = np.ones(self.num_envs, dtype=np.bool_)
         self.training_count = 0
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
 
         # Initialize network model
         self.networks = DeepQNetwork(self.total_action,
@@ -201,19 +267,21 @@ class Agent(object):
                                      input_dimension=self.input_dimension,
                                      batch_size=self.batch_size,
                                      discount_factor=self.discount_factor,
-                                     load_path=self.load_path)
+                                     load_path=self.load_path,
+                                     per_sample_targets=per_sample_targets)
         self.networks.target_model.set_weights(self.networks.model.get_weights())
-        
-    # Storing transition into memory
+
+        # NumPy copy of the online network used for acting, synced lazily
+        # after training
+        self.inference = QNetworkInference.from_model(self.networks.model)
+        self.inference_stale = False
+
+    # Storing transition into memory, one row per environment
+    # Only the newest frame of the state is kept; the previous frames and the
+    # next state are rebuilt from the neighbouring slots when sampling.
     def store_transition(self, state, action, reward, next, terminate):
-        exp = ({'state': state,
-                'action': action, 
-                'reward': reward, 
-                'next': next, 
-                'terminate': terminate})
-        if len(self.memory) >= self.memory_size:
-            self.memory.pop(0)
-        self.memory.append(exp)
+        self.memory.append(state[:, -1], action, reward, terminate, start=self.new_episode)
+        self.new_episode = np.array(terminate, dtype=np.bool_).reshape(self.num_envs)
 
     # Policy
     def choose_action(self, state, testing=False):
@@ -221,10 +289,18 @@ class Agent(object):
         if random.random() <= epsilon:
             action = np.random.choice(self.total_action)
         else:
-            q_val = self.networks.predict(state)
+            q_val = self.q_values(state)
             action = np.argmax(q_val)
         return action
 
+    # Policy for a batch of states, one forward pass for all environments
+    def choose_actions(self, states, testing=False):
+        epsilon = 0.05 if testing else self.epsilon
+        actions = np.argmax(self.q_values(states), axis=1)
+        explore = np.random.random(len(states)) <= epsilon
+        actions[explore] = np.random.choice(self.total_action, size=np.count_nonzero(explore))
+        return actions
+
     def update_epsilon(self):
         if self.epsilon - self.epsilon_decay > 0.1:
             self.epsilon -= self.epsilon_decay
@@ -233,268 +309,536 @@ class Agent(object):
 
     # Sampling
     def sample_exp_batch(self):
-        batch = []
-        for i in range(self.batch_size):
-            batch.append(self.memory[randrange(0, len(self.memory))])
-        return np.asarray(batch)
+        if self.prioritized:
+            return self.memory.sample(self.batch_size, beta=self.memory.beta_at(self.training_count))
+        return self.memory.sample(self.batch_size)
+
+    # Q values of uint8 states from the inference copy of the online network
+    def q_values(self, states):
+        if self.inference_stale:
+            self.inference.sync(self.networks.model)
+            self.inference_stale = False
+        return self.inference(states)
 
     def max_q(self, state):
-        q_values = self.networks.model.predict(state)
+        q_values = self.q_values(state)
         idxs = np.argwhere(q_values == np.max(q_values)).ravel()
         return np.random.choice(idxs)
 
     # Learning with Experience Replay
     def learn(self):
-        self.training_count += 1
-        batch = self.sample_exp_batch()
-        return self.networks.train(batch, self.networks.target_model)
+        self.inference_stale = True
+        with self.metrics.timer('replay_sample'):
+            batch = self.sample_exp_batch()
+        train_result = self.train_batch(batch)
+        self.update_priorities(batch)
+        return train_result
 
+    # One update on a sampled batch; AsyncLearner calls it from its own thread
+    def train_batch(self, batch):
+        self.training_count += 1
+        with self.metrics.timer('train'):
+            train_result = self.networks.train(batch, self.networks.target_model)
+        self.metrics.count('updates')
+        return train_result
 
-def preprocess(observation):
-    global IMG_SIZE
-    # start:stop:slice, ::step back 2 step a time
-    image = observation[1:176:2, ::2]
-    image = Image.fromarray(image, 'RGB').convert('L').resize(IMG_SIZE)
-    return np.asarray(image.getdata(), dtype=np.uint8).reshape(image.size[1], image.size[0])
+    def update_priorities(self, batch):
+        if self.prioritized:
+            self.memory.update_priorities(batch['index'], self.networks.td_errors)
 
 
+# Allocating version of FrameStacker.push, for a single (4, 84, 84) stack
 def shift(current_stack, observation):
     return np.append(current_stack[1:], [observation], axis=0)
 
 
-max_mean_score = 0
-
-def evaluate(DQA):
-    global max_mean_score
-    env = gym.make(ENV_ID)
-    # env = Monitor(env, './videos', force=True, video_callable=lambda episode: True)
-    scores = list()
-    frame_counter = 0
-
-    while frame_counter < 10000:
-        obs = preprocess(env.reset())
-
-        # Initialize the first state with the same 4 images
-        current_state = np.array([obs, obs, obs, obs])
-        frame_counter += 1
-        score = 0
-        t = 0
-        live = 3
-        done = False
-        episode = 0
-
-        # Start episode
-        while not done or live > 0:
-            action = DQA.choose_action(np.asarray([current_state]), testing=True)
-            obs, reward, done, info = env.step(action)
-            live = info['ale.lives']
-            obs = preprocess(obs)
-            current_state = shift(current_state, obs)
-            score += reward
-            t += 1
-            frame_counter += 1
-
-            # End episode
-            if done or live < 1 or t > 5000:
-                episode += 1
-                scores.append([t, score])
-                break
-
-    # clear_output()
-    scores = np.asarray(scores)
-    max_indices = np.argwhere(scores[:, 1] == np.max(scores[:, 1])).ravel()
-    max_idx = np.random.choice(max_indices)
-
-    # Save best model
-    if max_mean_score < np.mean(scores):
-        max_mean_score = np.mean(scores)
-        agent.networks.model.save_weights(str(scores[len(scores)-1]) + '_best.h5')
-
-    return scores[max_idx, :].ravel()
-
-
-def plot(x, y, z=None, mode=None, filename=None):
-    fig = plt.figure()
-    ax = fig.add_subplot(111, label="1")
-    ax2 = fig.add_subplot(111, label="2", frame_on=False)
-
-    max_score = np.max(y)
-    min_score = np.min(y)
-    max_index = np.where(y == max_score)
-    min_index = np.where(y == min_score)
-
-    # ax | x = eps, yl = epsilon, bl
-    # ax | x = eps, yr = scores, yo
-    ax.plot(x, z, color="C0")
-    ax.set_xlabel("Game", color="C0")
-    ax.set_ylabel("Epsilon", color="C0")
-    ax.tick_params(axis='x', colors="C0")
-    ax.tick_params(axis='y', colors="C0")
-
-    if mode == 0:
-        # The Scores History Scatter Graph
-        print('train:', max_score, ' ', min_score)
-        print('train:', max_index, ' ', min_index)
-
-        max_score_str = 'Max Score=' + str(max_score)
-        min_score_str = 'Min Score=' + str(min_score)
-        plt.text(0, max_score, max_score_str)
-        plt.text(0, max_score - 300, min_score_str)
-        ax2.scatter(x, y, color="C1")
-    elif mode == 1:
-        # The Average Scores History Scatter Graph
-        N = len(y)
-        running_avg = np.empty(N)
-        for t in range(N):
-            running_avg[t] = np.mean(y[max(0, t - 20):(t + 1)])
-
-        max_avg_score = np.max(running_avg)
-        min_avg_score = np.min(running_avg)
-        print('avg:', max_avg_score, ' ', min_avg_score)
-
-        max_avg_index = np.where(y == max_avg_score)
-        min_avg_index = np.where(y == min_avg_score)
-        print('avg:', max_avg_index, ' ', min_avg_index)
-
-        max_avg_score_str = 'Max Score=' + str(max_avg_score)
-        min_avg_score_str = 'Min Score=' + str(min_avg_score)
-        plt.text(0, max_avg_score, max_avg_score_str)
-        plt.text(0, max_avg_score - 80, min_avg_score_str)
-        ax2.scatter(x, running_avg, color="C1")
-
-    ax2.axes.get_xaxis().set_visible(False)
-    ax2.yaxis.tick_right()
-    ax2.set_ylabel('Score', color="C1")
-    ax2.yaxis.set_label_position('right')
-    ax2.tick_params(axis='y', colors="C1")
-
-    ax.set_title(filename)
-    if filename is not None:
-        plt.savefig(filename)
-    plt.show()
-
 # Hyperparameters
 ALPHA = 0.0025
 EPSILON = 0.95
-EPSILON_DECAY = 0.005
+EPSILON_DECAY = 0.02
 GAMMA = 0.95
 INPUT_DIMS = (4, 84, 84)
 BATCH_SIZE = 32
 MEMORY_SIZE = 1000000
+REPLAY_DIR = None
 MAX_EPISODE = 500
 ENV_ID = 'MsPacmanDeterministic-v4'
+LOAD_PATH = None
+SEED = None
+PER_SAMPLE_TARGETS = False
+
+NUM_ENVS = 8
+REPLAY_RATIO = 0.25
+ASYNC_LEARNER = False
+ACTING_SYNC = 10
+NUM_EVAL_WORKERS = 2
+
+PRIORITIZED_REPLAY = False
+PRIORITY_ALPHA = 0.6
+PRIORITY_BETA = 0.4
+PRIORITY_BETA_STEPS = 250000
+
+VIDEO_DIR = './videos/280220'
+VIDEO_POLICY = 'every'
+VIDEO_EVERY = 10
+
+STATISTICS_PATH = './statistics_280220.npz'
+REPORT_EVERY = 100
+
+RECORD_DIR = None
+RECORD_SHARD_SIZE = 50000
+WARM_START_DIR = None
+
+METRICS = True
+METRICS_PATH = './metrics/280220.jsonl'
+METRICS_FLUSH_SECONDS = 60
+PROFILE_STEPS = 1000
+
+CHECKPOINT_DIR = './checkpoints/280220'
+CHECKPOINT_FREQUENCY = 100000
+CHECKPOINT_SECONDS = None
+CHECKPOINT_REPLAY = False
 
 IMG_SIZE = (84, 84)
 
-# Setup
-# Environment
-env = gym.make(ENV_ID)
-env = Monitor(env, './videos/280220', force=True, video_callable=lambda episode: True)
-agent = Agent(env.action_space.n, learning_rate=ALPHA, 
-              input_dimension=INPUT_DIMS, batch_size=BATCH_SIZE,
-              discount_factor=GAMMA, memory_size=MEMORY_SIZE, epsilon=EPSILON,
-              epsilon_decay=EPSILON_DECAY, load_path="checkpoint_0.025_1_270220.h5")
-#"[811. 440.]_best.h5"
-
-print('Action space:', env.action_space.n, '\n',
-      'Action meaning:', env.unwrapped.get_action_meanings(), '\n',
-      'Observation space:', env.observation_space.shape, '\n')
-
-# Containers
-train_result = []
-score_array = []
-epsilons = []
-
-# Evaluation
-t_eval = []
-score_eval = []
-eps_eval = []
-
-# Counters
-episode_counter = 0
-frame_counter = 0
-
-# Main
-while episode_counter < MAX_EPISODE:
-    score = 0
-    observation = preprocess(env.reset())
-    stacked_frames = np.array([observation, observation, observation, observation])
-    # stacked_frames = np.reshape([stacked_frames], (1, 84, 84, 4))
-
-    timestep = 0
-    done = False
-    frame_counter += 1
-    live = 3
-    reward = 0
-    info = []
-    # print('Episode:', episode_counter)
-
-    while not done or live > 0:
-        # Choose an action
-        action = agent.choose_action(np.asarray([stacked_frames]))
-        observation, reward, done, info = env.step(action)
-        observation = preprocess(observation)
-
-        # im = Image.fromarray(np.uint8(observation))
+
+# n updates, syncing the target network and decaying epsilon every 10000
+def learn_steps(agent, n):
+    for _ in range(n):
+        agent.learn()
+        if agent.training_count % 10000 == 0:
+            agent.networks.target_model.set_weights(agent.networks.model.get_weights())
+            agent.update_epsilon()
+
+
+class TrainingLoop(object):
+    """The body of the training loop, one step of every environment per call.
+
+    ``train`` builds one with everything it runs, and the end-to-end
+    benchmarks build the same one, so the benchmark times exactly what
+    training does. Every part but ``agent`` and ``envs`` is optional:
+    ``learner`` trains on its own thread instead of inline, ``recorder``
+    writes every transition to disk, ``evaluator`` gets a snapshot every
+    ``evaluate_every`` frames, ``checkpoints`` is asked to save every step,
+    ``statistics`` collects episode and evaluation scores and ``reports``
+    draws them every ``report_every`` episodes. ``train_lock`` is held while
+    the networks are copied for evaluation or checkpoints.
+
+    ``step`` returns the ``(env_index, score)`` of every episode it finished.
+    """
+
+    def __init__(self, agent, envs, replay_ratio=0.25, learn_start=1000, metrics=None, learner=None,
+                 recorder=None, evaluator=None, evaluate_every=10000, checkpoints=None,
+                 statistics=None, reports=None, report_every=0, train_lock=None, verbose=True):
+        self.agent = agent
+        self.envs = envs
+        self.replay_ratio = replay_ratio
+        self.learn_start = learn_start
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+        self.learner = learner
+        self.recorder = recorder
+        self.evaluator = evaluator
+        self.evaluate_every = evaluate_every
+        self.checkpoints = checkpoints
+        self.statistics = statistics
+        self.reports = reports
+        self.report_every = report_every
+        self.train_lock = train_lock if train_lock is not None else contextlib.nullcontext()
+        self.verbose = verbose
+
+        # Counters
+        self.episode_counter = 0
+        self.frame_counter = envs.num_envs
+
+        # Per environment episode accounting
+        self.scores = np.zeros(envs.num_envs)
+        self.lives = np.full(envs.num_envs, 3)
+        self.stacked_frames = None
+
+    def reset(self):
+        self.stacked_frames = self.envs.reset()
+
+    # Saved with every checkpoint and handed back by CheckpointManager.restore
+    def counters(self):
+        counters = {'episode_counter': self.episode_counter, 'frame_counter': self.frame_counter}
+        if self.statistics is not None:
+            counters['statistics'] = self.statistics.get_state()
+        if self.evaluator is not None:
+            counters['max_mean_score'] = self.evaluator.max_mean_score
+        return counters
+
+    def step(self):
+        agent, metrics, num_envs = self.agent, self.metrics, self.envs.num_envs
+        # Choose an action for every environment with one forward pass
+        with metrics.timer('choose_action'):
+            actions = agent.choose_actions(self.stacked_frames)
+        # The workers preprocess and stack the frames, so this covers both
+        with metrics.timer('env_step'):
+            next_state, rewards, dones, infos = self.envs.step(actions)
+        self.lives[:] = [info['ale.lives'] for info in infos]
+
+        # from PIL import Image
+        # im = Image.fromarray(np.uint8(next_state[0, -1]))
         # if frame_counter < 1000:
         #     file_name = 'preprocess_' + str(frame_counter) + '.png'
         #     im.save(file_name)
 
-        next_state = shift(stacked_frames, observation)
-        live = info['ale.lives']
-
-        frame_counter += 1
-
         # Store experience
-        clip = np.clip(reward, -1, 1)
-        agent.store_transition(np.asarray([stacked_frames]), action,
-                               clip, np.asarray([next_state]), done)
-
-        # Train
-        if len(agent.memory) >= 1000:
-            if timestep % 4 == 0:
-                agent.learn()
+        clip = np.clip(rewards, -1, 1)
+        with metrics.timer('store_transition'):
+            if self.learner is not None:
+                self.learner.store_transition(self.stacked_frames, actions, clip, next_state, dones)
+            else:
+                agent.store_transition(self.stacked_frames, actions, clip, next_state, dones)
+            if self.recorder is not None:
+                self.recorder.store_transition(self.stacked_frames, actions, clip, next_state, dones,
+                                               self.lives)
+
+        # replay_ratio updates per frame, inline or on the learner thread
+        previous_frames = self.frame_counter
+        self.frame_counter += num_envs
+        if self.learner is not None:
+            with metrics.timer('learn'):
+                self.learner.observe(num_envs)
+        elif len(agent.memory) >= self.learn_start:
+            with metrics.timer('learn'):
+                learn_steps(agent, int(self.frame_counter * self.replay_ratio) -
+                            int(previous_frames * self.replay_ratio))
+
+        # Eval scores, collected whenever a worker has finished
+        if self.evaluator is not None:
+            with metrics.timer('evaluate'):
+                if self.frame_counter // self.evaluate_every > previous_frames // self.evaluate_every:
+                    with self.train_lock:
+                        self.evaluator.submit(agent.networks.model, self.frame_counter, self.episode_counter)
+                for frame, eps, t, s in self.evaluator.poll():
+                    if self.statistics is not None:
+                        self.statistics.add_evaluation(frame, eps, t, s)
+
+        if self.checkpoints is not None:
+            with metrics.timer('checkpoint'):
+                self.checkpoints.maybe_save(agent, self.frame_counter, self.counters, lock=self.train_lock)
+
+        metrics.count('frames', num_envs)
+        metrics.count('episodes', np.count_nonzero(dones))
+        metrics.gauge('replay_size', len(agent.memory))
+        metrics.gauge('epsilon', agent.epsilon)
+        metrics.step()
+
+        self.stacked_frames = next_state
+        self.scores += rewards
+
+        finished = []
+        for env_index in np.flatnonzero(dones):
+            score = self.scores[env_index]
+            finished.append((env_index, score))
+            if self.statistics is not None:
+                self.statistics.add_episode(score, agent.epsilon, self.frame_counter)
+                metrics.gauge('score_avg', self.statistics.rolling_mean)
+
+            if self.verbose:
+                print('Score:', score, 'Env:', env_index, 'Lives:', self.lives[env_index])
+                print('Eps:', self.episode_counter, 'Training #', agent.training_count)
+            self.scores[env_index] = 0
+            # The worker has already reset this environment
+            self.frame_counter += 1
+
+            real_eps = self.episode_counter + 1
+            if self.reports is not None and self.report_every and real_eps % self.report_every == 0:
+                self.reports.submit(self.statistics, self.episode_counter)
+
+            self.episode_counter += 1
+        return finished
+
+
+def train(config):
+    if config.resume and CheckpointManager.latest_in(config.checkpoint_dir) is None:
+        sys.exit('No checkpoint to resume from in ' + config.checkpoint_dir + ' - check --checkpoint-dir')
+
+    # Setup
+    preprocess = FramePreprocessor(config.img_size)
+    if config.seed is not None:
+        random.seed(config.seed)
+        np.random.seed(config.seed)
+        import keras
+        if hasattr(keras.utils, 'set_random_seed'):
+            keras.utils.set_random_seed(config.seed)
+    # Timings go to --metrics-path; kill -USR1 <pid> profiles the next --profile-steps steps
+    metrics = Metrics(config.metrics_path, flush_seconds=config.metrics_flush_seconds, enabled=config.metrics)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: metrics.request_profile(config.profile_steps))
+
+    # Environment
+    # Videos of every --video-every-th training episode ('every'), of new best
+    # training scores ('best') or of evaluation episodes ('evaluation')
+    video = {'directory': config.video_dir, 'policy': 'every', 'every': config.video_every}
+    train_video = dict(video, policy=config.video_policy) if config.video_policy in ('every', 'best') else None
+    eval_video = video if config.video_policy == 'evaluation' else None
+    envs = SubprocVecEnv(config.env_id, config.num_envs, preprocess, frame_shape=config.input_dims[1:],
+                         history_length=config.input_dims[0], video=train_video,
+                         seed=config.seed)
+    agent = Agent(envs.total_action, learning_rate=config.alpha,
+                  input_dimension=config.input_dims, batch_size=config.batch_size,
+                  discount_factor=config.gamma, memory_size=config.memory_size, epsilon=config.epsilon,
+                  epsilon_decay=config.epsilon_decay, load_path=config.load_path,
+                  num_envs=config.num_envs, prioritized=config.prioritized_replay,
+                  priority_alpha=config.priority_alpha, priority_beta=config.priority_beta,
+                  priority_beta_steps=config.priority_beta_steps, metrics=metrics,
+                  per_sample_targets=config.per_sample_targets, replay_dir=config.replay_dir)
+    #"[811. 440.]_best.weights.h5"
+    evaluator = AsyncEvaluator(config.env_id, preprocess, input_dims=config.input_dims,
+                               num_workers=config.num_eval_workers, video=eval_video)
+    # A frequency of 0 leaves only the --checkpoint-seconds timer
+    checkpoints = CheckpointManager(config.checkpoint_dir, every_steps=config.checkpoint_frequency or None,
+                                    every_seconds=config.checkpoint_seconds,
+                                    save_replay=config.checkpoint_replay)
+
+    print('Action space:', envs.total_action, '\n',
+          'Action meaning:', envs.action_meanings, '\n',
+          'Observation space:', envs.observation_shape, '\n',
+          'Environments:', config.num_envs, '\n')
+
+    # Training and evaluation series; plots are drawn by the report worker
+    statistics = EpisodeStatistics()
+    reports = ReportRenderer(export_path=config.statistics_path)
+
+    # Continue from the latest checkpoint; episodes in progress restart
+    counters = checkpoints.restore(agent) if config.resume else None
+    if counters is not None:
+        statistics = EpisodeStatistics.from_state(counters['statistics'])
+        evaluator.max_mean_score = counters['max_mean_score']
+        print('Resumed at frame', counters['frame_counter'], 'episode', counters['episode_counter'])
+    elif config.warm_start_dir is not None:
+        print('Warm start with', warm_start(agent.memory, config.warm_start_dir), 'transitions')
+
+    # Every transition on disk as well, for warm starts and offline training
+    recorder = None
+    if config.record_dir is not None:
+        recorder = TransitionRecorder(config.record_dir, num_envs=config.num_envs,
+                                      frame_shape=config.input_dims[1:], shard_size=config.record_shard_size,
+                                      metadata={'env_id': config.env_id, 'total_action': envs.total_action})
+
+    # With --async-learner, training runs on a background thread; train_lock is
+    # held while the networks are copied for evaluation or checkpoints
+    learner = None
+    train_lock = None
+    if config.async_learner:
+        learner = AsyncLearner(agent, replay_ratio=config.replay_ratio, acting_sync=config.acting_sync)
+        train_lock = learner.train_lock
+
+    loop = TrainingLoop(agent, envs, replay_ratio=config.replay_ratio, metrics=metrics, learner=learner,
+                        recorder=recorder, evaluator=evaluator, checkpoints=checkpoints,
+                        statistics=statistics, reports=reports, report_every=config.report_every,
+                        train_lock=train_lock)
+    if counters is not None:
+        loop.episode_counter = counters['episode_counter']
+        loop.frame_counter = counters['frame_counter']
+
+    # Main
+    loop.reset()
+    while loop.episode_counter < config.max_episode:
+        loop.step()
+
+    envs.close()
+    if learner is not None:
+        learner.close()
+    if recorder is not None:
+        recorder.close()
+    # The finished run, for evaluate and resume
+    with loop.train_lock:
+        checkpoints.save(agent, loop.frame_counter, loop.counters, block=True)
+    checkpoints.close()
+    metrics.close()
+    for frame, eps, t, s in evaluator.close():
+        statistics.add_evaluation(frame, eps, t, s)
+    reports.close()
+    statistics.export(config.statistics_path)
+    print('Max_mean_score:', evaluator.max_mean_score)
+
+
+def evaluate_command(config):
+    import gym
+
+    env = gym.make(config.env_id)
+    networks = DeepQNetwork(env.action_space.n, input_dimension=config.input_dims,
+                            load_path=config.load_path)
+    if config.load_path is None:
+        weights = load_weights(config.checkpoint_dir)
+        if weights is None:
+            print('No checkpoint in', config.checkpoint_dir, '- pass --load-path')
+            env.close()
+            return
+        networks.model.set_weights(weights)
+    network = QNetworkInference.from_model(networks.model)
+
+    # Same 5% exploration as Agent.choose_action(testing=True)
+    def choose_action(state):
+        if random.random() <= 0.05:
+            return random.randrange(env.action_space.n)
+        return int(np.argmax(network(state)))
+
+    scores = run_evaluation(env, FramePreprocessor(config.img_size), choose_action,
+                            input_dims=config.input_dims, max_frames=config.eval_frames)
+    env.close()
+    t, score = best_episode(scores)
+    print('Episodes:', len(scores), 'Mean score:', np.mean(scores[:, 1]),
+          'Best score:', score, 'in', int(t), 'steps')
+
+
+def offline_command(config):
+    dataset = TransitionDataset(config.dataset, history_length=config.input_dims[0])
+    metrics = Metrics(config.metrics_path, flush_seconds=config.metrics_flush_seconds, enabled=config.metrics)
+    agent = Agent(dataset.total_action, learning_rate=config.alpha,
+                  input_dimension=config.input_dims, batch_size=config.batch_size,
+                  discount_factor=config.gamma, memory_size=dataset.num_envs, epsilon=config.epsilon,
+                  epsilon_decay=config.epsilon_decay, load_path=config.load_path,
+                  num_envs=dataset.num_envs, metrics=metrics,
+                  per_sample_targets=config.per_sample_targets)
+    # Replay comes from the recording, the emulator is never started
+    agent.memory = dataset
+    checkpoints = CheckpointManager(config.checkpoint_dir, every_steps=config.checkpoint_frequency or None,
+                                    every_seconds=config.checkpoint_seconds)
+    print('Offline training on', len(dataset), 'transitions from', config.dataset)
+
+    for step in range(1, config.steps + 1):
+        learn_steps(agent, 1)
+        checkpoints.maybe_save(agent, step, {'offline_step': step})
+        metrics.step()
+
+    checkpoints.save(agent, config.steps, {'offline_step': config.steps})
+    dataset.close()
+    checkpoints.close()
+    metrics.close()
+
+
+def bench_command(config):
+    import runpy
+
+    suite = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'suite.py')
+    sys.argv = [suite] + config.bench_args
+    # As if run as a script, so the suite finds synthetic_env next to it
+    sys.path.insert(0, os.path.dirname(suite))
+    runpy.run_path(suite, run_name='__main__')
+
+
+# Hyperparameter globals exposed as flags, e.g. ALPHA as --alpha; the flag
+# type follows the default unless given as a third item
+HYPERPARAMETERS = [
+    ('ALPHA', 'learning rate'),
+    ('EPSILON', 'initial exploration rate'),
+    ('EPSILON_DECAY', 'epsilon decrease every 10000 training steps'),
+    ('GAMMA', 'discount factor'),
+    ('INPUT_DIMS', 'network input, history length and frame size'),
+    ('BATCH_SIZE', 'minibatch size'),
+    ('MEMORY_SIZE', 'replay memory capacity'),
+    ('REPLAY_DIR', 'keep the replay frames in a memory-mapped file here', str),
+    ('MAX_EPISODE', 'number of training episodes'),
+    ('ENV_ID', 'gym environment id'),
+    ('LOAD_PATH', 'weights (.h5) to start from', str),
+    ('SEED', 'seed of the agent and environments', int),
+    ('PER_SAMPLE_TARGETS', 'build Q targets one experience at a time (slow reference)'),
+    ('NUM_ENVS', 'environments played in parallel'),
+    ('REPLAY_RATIO', 'training steps per frame'),
+    ('ASYNC_LEARNER', 'train on a background thread'),
+    ('ACTING_SYNC', 'training steps between acting network refreshes'),
+    ('NUM_EVAL_WORKERS', 'evaluation worker processes'),
+    ('PRIORITIZED_REPLAY', 'sample transitions by TD error'),
+    ('PRIORITY_ALPHA', 'prioritization exponent'),
+    ('PRIORITY_BETA', 'initial importance-sampling exponent'),
+    ('PRIORITY_BETA_STEPS', 'training steps to anneal beta to 1'),
+    ('VIDEO_DIR', 'video directory'),
+    ('VIDEO_POLICY', 'every, best, evaluation or none'),
+    ('VIDEO_EVERY', 'record every Nth episode'),
+    ('STATISTICS_PATH', 'exported score series (.npz)'),
+    ('REPORT_EVERY', 'episodes between plots and exports, 0 for none'),
+    ('RECORD_DIR', 'record every transition to this directory', str),
+    ('RECORD_SHARD_SIZE', 'transitions per recorded shard'),
+    ('WARM_START_DIR', 'fill the replay memory from this recording first', str),
+    ('METRICS', 'record loop timings'),
+    ('METRICS_PATH', 'metrics file (.jsonl or .csv)'),
+    ('METRICS_FLUSH_SECONDS', 'seconds between metrics rows'),
+    ('PROFILE_STEPS', 'steps profiled after SIGUSR1'),
+    ('CHECKPOINT_DIR', 'checkpoint directory'),
+    ('CHECKPOINT_FREQUENCY', 'frames between checkpoints, 0 for none'),
+    ('CHECKPOINT_SECONDS', 'seconds between checkpoints', float),
+    ('CHECKPOINT_REPLAY', 'save the replay memory with checkpoints'),
+    ('IMG_SIZE', 'preprocessed frame size'),
+]
+
+
+def add_hyperparameters(parser):
+    for name, help, *kind in HYPERPARAMETERS:
+        default = globals()[name]
+        flag = '--' + name.lower().replace('_', '-')
+        if isinstance(default, bool):
+            parser.add_argument(flag, action=argparse.BooleanOptionalAction, default=default, help=help)
+        elif isinstance(default, tuple):
+            parser.add_argument(flag, type=int, nargs=len(default), default=default,
+                                help=help + ' (default: %(default)s)')
+        else:
+            parser.add_argument(flag, type=kind[0] if kind else type(default),
+                                default=default, help=help + ' (default: %(default)s)')
+
+
+def parse_args(argv=None):
+    """Command line, with defaults from the globals above and ``--config``.
+
+    A config file is JSON mapping hyperparameter names, as ``ALPHA`` or
+    ``alpha``, to values; flags given on the command line win over it.
+    Without a command, ``train`` is run.
+    """
+    parser = argparse.ArgumentParser(description='Deep Q-learning on Atari games.')
+    commands = parser.add_subparsers(dest='command')
+    for command, help in (('train', 'start a training run'),
+                          ('resume', 'continue from the latest checkpoint in --checkpoint-dir'),
+                          ('evaluate', 'play with --load-path or the latest checkpoint'),
+                          ('offline', 'train on recorded transitions, without the emulator')):
+        subparser = commands.add_parser(command, help=help)
+        subparser.add_argument('--config', help='JSON file of hyperparameters')
+        add_hyperparameters(subparser)
+        if command == 'evaluate':
+            subparser.add_argument('--eval-frames', type=int, default=10000,
+                                   help='frames to play (default: 10000)')
+        if command == 'offline':
+            subparser.add_argument('dataset', help='directory written with --record-dir')
+            subparser.add_argument('--steps', type=int, default=1000000,
+                                   help='training steps (default: 1000000)')
+    bench = commands.add_parser('bench', help='run benchmarks/suite.py with the remaining arguments')
+    bench.add_argument('bench_args', nargs=argparse.REMAINDER)
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # -t is the old way to start training
+    argv = [arg for arg in argv if arg != '-t']
+    if not argv or argv[0] not in commands.choices and argv[0] not in ('-h', '--help'):
+        argv = ['train'] + argv
+    if argv[0] == 'bench' and argv[1:2] not in (['-h'], ['--help']):
+        # Passed on untouched, argparse would take the suite's flags for its own
+        return argparse.Namespace(command='bench', bench_args=argv[1:], resume=False)
+    args = parser.parse_args(argv)
+    if getattr(args, 'config', None):
+        with open(args.config) as f:
+            values = {name.lower(): value for name, value in json.load(f).items()}
+        commands.choices[args.command].set_defaults(**values)
+        args = parser.parse_args(argv)
+
+    for name in ('input_dims', 'img_size'):
+        if hasattr(args, name):
+            setattr(args, name, tuple(getattr(args, name)))
+    args.resume = args.command == 'resume'
+    return args
+
+
+def main(argv=None):
+    config = parse_args(argv)
+    if config.command == 'bench':
+        bench_command(config)
+    elif config.command == 'evaluate':
+        evaluate_command(config)
+    elif config.command == 'offline':
+        offline_command(config)
+    else:
+        train(config)
 
-        if agent.training_count % 10000 == 0 and agent.training_count >= 10000:
-            agent.networks.target_model.set_weights(agent.networks.model.get_weights())
-            agent.update_epsilon()
 
-        # Eval scores
-        if frame_counter % 10000 == 0:
-            t, s = evaluate(agent)
-            t_eval.append(t)
-            score_eval.append(s)
-            eps_eval.append(episode_counter)
-
-        stacked_frames = next_state
-        score += reward
-        timestep += 1
-
-    score_array.append(score)
-    epsilons.append(agent.epsilon)
-
-    print('Score:', score)
-    # print('Lives:', info['ale.lives'], 'Done:', ydone)
-    print('Eps:', episode_counter, 'Training #', agent.training_count)
-
-    real_eps = episode_counter + 1
-    episodes = [i + 1 for i in range(real_eps)]
-
-    if real_eps >= 100 and real_eps % 100 == 0:
-        try:
-            plot(np.asarray(episodes), np.asarray(score_array), epsilons, 0, "train plot_" + str(episode_counter))
-        except ValueError as e:
-            print(e)
-        except Exception as e:
-            print(e)
-
-        try:
-            plot(np.asarray(episodes), np.asarray(score_array), epsilons, 1, "average plot_" + str(episode_counter))
-        except ValueError as e:
-            print(e)
-        except Exception as e:
-            print(e)
-
-    episode_counter += 1
-
-print('Max_mean_score:', max_mean_score)
+if __name__ == '__main__':
+    main()
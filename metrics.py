@@ -0,0 +1,221 @@
+import cProfile
+import csv
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __call__(self, fn):
+        return fn
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, stats, lock):
+        self.stats = stats
+        self.lock = lock
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stats = self.stats
+        with self.lock:
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            with self:
+                return fn(*args, **kwargs)
+        return timed
+
+
+class Metrics(object):
+    """Per-phase timers, counters and gauges for the training loop.
+
+    ``timer(name)`` works as a context manager or a decorator and adds to the
+    call count, total and slowest time of ``name``. ``count`` adds to a
+    counter and ``gauge`` keeps the last value. Everything is aggregated in
+    memory; ``step`` is called once per loop iteration and, every
+    ``flush_seconds``, writes one summary to ``path`` and starts a new
+    interval. Counters are reported as totals and as ``<name>_per_sec``
+    over the interval, timers as calls, mean and max milliseconds and
+    ``share`` of the interval's wall time.
+
+    A ``path`` ending in ``.csv`` is written as ``time,step,metric,value``
+    rows, anything else as one JSON object per line. The file stays open
+    with a large buffer and is only flushed at the end of each interval.
+
+    ``request_profile(steps)`` runs cProfile over the next ``steps`` calls to
+    ``step`` and saves the stats next to ``path``, so a slow run can be
+    looked at without restarting it; ``main.py`` wires it to ``SIGUSR1``.
+
+    Timers, counters and gauges may be updated from other threads, such as
+    the ``AsyncLearner`` ones, while the loop thread flushes.
+
+    With ``enabled=False`` every method returns at once and ``timer`` hands
+    back one shared no-op object.
+    """
+
+    def __init__(self, path=None, flush_seconds=60, enabled=True):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.enabled = enabled
+
+        self.timers = {}
+        self.counters = {}
+        self.totals = {}
+        self.gauges = {}
+        self.steps = 0
+        self.last_flush = time.time()
+        self._lock = threading.RLock()
+
+        self._file = None
+        self._csv = None
+        if self.enabled and self.path is not None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, 'a', buffering=1 << 16, newline='')
+            if self.path.endswith('.csv'):
+                self._csv = csv.writer(self._file)
+                if self._file.tell() == 0:
+                    self._csv.writerow(['time', 'step', 'metric', 'value'])
+
+        self._profiler = None
+        self._profile_steps = 0
+        self._profile_pending = 0
+
+    def timer(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        stats = self.timers.get(name)
+        if stats is None:
+            with self._lock:
+                stats = self.timers.setdefault(name, [0, 0.0, 0.0])
+        return _Timer(stats, self._lock)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.gauges[name] = value
+
+    # Called once per training loop iteration
+    def step(self, n=1):
+        if not self.enabled:
+            return
+        self.steps += n
+        if self._profile_pending:
+            self._start_profile()
+        elif self._profiler is not None:
+            self._profile_steps -= n
+            if self._profile_steps <= 0:
+                self._stop_profile()
+        if time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def summary(self):
+        with self._lock:
+            elapsed = max(time.time() - self.last_flush, 1e-9)
+            row = {'time': round(time.time(), 3), 'step': self.steps, 'seconds': round(elapsed, 3)}
+            for name, value in self.counters.items():
+                row[name] = self.totals.get(name, 0) + value
+                row[name + '_per_sec'] = value / elapsed
+            for name, (calls, total, slowest) in self.timers.items():
+                if calls == 0:
+                    continue
+                row[name + '_calls'] = calls
+                row[name + '_ms'] = 1e3 * total / calls
+                row[name + '_max_ms'] = 1e3 * slowest
+                row[name + '_share'] = total / elapsed
+            row.update(self.gauges)
+            return row
+
+    # Starts a new interval; returns the finished one's summary
+    def _reset(self):
+        with self._lock:
+            row = self.summary()
+            for name, value in self.counters.items():
+                self.totals[name] = self.totals.get(name, 0) + value
+            self.counters = dict.fromkeys(self.counters, 0)
+            for stats in self.timers.values():
+                stats[:] = [0, 0.0, 0.0]
+            self.last_flush = time.time()
+        return row
+
+    def flush(self):
+        if not self.enabled:
+            return None
+        # The file is written outside the lock, so other threads never wait on it
+        row = self._reset()
+        if self._csv is not None:
+            for name, value in row.items():
+                if name not in ('time', 'step'):
+                    self._csv.writerow([row['time'], row['step'], name, value])
+            self._file.flush()
+        elif self._file is not None:
+            # NumPy scalars, e.g. counts from np.count_nonzero, as Python numbers
+            self._file.write(json.dumps(row, default=lambda value: value.item()) + '\n')
+            self._file.flush()
+        return row
+
+    # Safe to call from a signal handler: profiling starts at the next step
+    def request_profile(self, steps=1000):
+        if self.enabled and self._profiler is None:
+            self._profile_pending = steps
+
+    def _start_profile(self):
+        self._profile_steps = self._profile_pending
+        self._profile_pending = 0
+        self._profile_start = self.steps
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+
+    def _stop_profile(self):
+        self._profiler.disable()
+        stream = io.StringIO()
+        stats = pstats.Stats(self._profiler, stream=stream).sort_stats('cumulative')
+        stats.print_stats(20)
+        print('Metrics: profile of steps', self._profile_start, 'to', self.steps)
+        print(stream.getvalue())
+        if self.path is not None:
+            stats.dump_stats('%s.profile_%d' % (os.path.splitext(self.path)[0], self._profile_start))
+        self._profiler = None
+
+    def close(self):
+        if not self.enabled:
+            return
+        if self._profiler is not None:
+            self._stop_profile()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,123 @@
+import numpy as np
+
+# ITU-R 601-2 luma transform, the one PIL uses for convert('L')
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def _bicubic(x, a=-0.5):
+    x = np.abs(x)
+    return np.where(x < 1, ((a + 2) * x - (a + 3)) * x * x + 1,
+                    np.where(x < 2, (((x - 5) * x + 8) * x - 4) * a, 0))
+
+
+def resize_weights(in_size, out_size):
+    """Bicubic resampling matrix of shape ``(out_size, in_size)``.
+
+    The coefficients follow PIL's ``Image.resize`` with the default BICUBIC
+    filter, including the wider support used when downsampling.
+    """
+    scale = in_size / out_size
+    filter_scale = max(scale, 1.0)
+    support = 2.0 * filter_scale
+
+    weights = np.zeros((out_size, in_size), dtype=np.float64)
+    for i in range(out_size):
+        center = (i + 0.5) * scale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+        x = np.arange(xmin, xmax)
+        k = _bicubic((x - center + 0.5) / filter_scale)
+        weights[i, xmin:xmax] = k / k.sum()
+    return weights.astype(np.float32)
+
+
+class FramePreprocessor(object):
+    """Pure NumPy version of the PIL based Atari frame preprocessing.
+
+    Frames are cropped to rows ``1:176`` and subsampled by two, converted to
+    grayscale and resized to ``img_size`` with precomputed bicubic weights.
+    It accepts one ``(210, 160, 3)`` frame or a ``(B, 210, 160, 3)`` batch and
+    can write into a preallocated ``uint8`` ``out`` array.
+
+    PIL rounds the grayscale image to 8 bits before resizing, which this
+    float32 pipeline does not, so outputs differ from ``preprocess_pil`` by at
+    most 2 gray levels per pixel.
+    """
+
+    def __init__(self, img_size=(84, 84), crop=(slice(1, 176, 2), slice(None, None, 2)),
+                 input_shape=(210, 160)):
+        self.img_size = tuple(img_size)
+        self.rows = crop[0]
+        rows = np.arange(input_shape[0])[crop[0]]
+        columns = np.arange(input_shape[1])[crop[1]]
+        width_out, height_out = self.img_size
+        self.row_weights = resize_weights(len(rows), height_out)
+
+        # Grayscale conversion and column subsampling folded into the
+        # horizontal pass: one matrix maps a full interleaved RGB row to the
+        # resized gray row, so no strided copy of the frame is needed.
+        col_weights = np.zeros((input_shape[1], 3, width_out), dtype=np.float32)
+        col_weights[columns] = (resize_weights(len(columns), width_out).T[:, np.newaxis, :] *
+                                LUMA_WEIGHTS[:, np.newaxis])
+        self.row_color_weights = col_weights.reshape(3 * input_shape[1], width_out)
+
+    def __call__(self, observation, out=None):
+        single = observation.ndim == 3
+        if single:
+            observation = observation[np.newaxis]
+
+        image = observation[:, self.rows]
+        image = image.reshape(image.shape[:2] + (-1,)).astype(np.float32)
+
+        # Horizontal then vertical pass, rounded to 8 bits in between as PIL does
+        resized = np.matmul(image, self.row_color_weights)
+        np.clip(resized, 0, 255, out=resized)
+        np.rint(resized, out=resized)
+        resized = np.matmul(self.row_weights, resized)
+        np.clip(resized, 0, 255, out=resized)
+        np.rint(resized, out=resized)
+
+        if out is None:
+            out = np.empty(resized.shape, dtype=np.uint8)
+        np.copyto(out.reshape(resized.shape), resized, casting='unsafe')
+        return out[0] if single and out.ndim == 3 else out
+
+
+def preprocess_pil(observation, img_size=(84, 84)):
+    """The original PIL preprocessing, kept as the reference output."""
+    from PIL import Image
+
+    image = observation[1:176:2, ::2]
+    image = Image.fromarray(image, 'RGB').convert('L').resize(img_size)
+    return np.asarray(image.getdata(), dtype=np.uint8).reshape(image.size[1], image.size[0])
+
+
+class FrameStacker(object):
+    """Keeps the last ``history_length`` frames of ``num_envs`` environments.
+
+    Every frame is written twice into a buffer of ``2 * history_length``
+    slots, so the frames in chronological order are always one contiguous
+    slice of it. ``stacked`` returns a ``(num_envs, history_length, *frame)``
+    view of that slice; nothing is allocated per step, and the view is valid
+    until the next ``push``.
+    """
+
+    def __init__(self, num_envs=1, history_length=4, frame_shape=(84, 84)):
+        self.history_length = history_length
+        self.buffer = np.zeros((num_envs, 2 * history_length) + tuple(frame_shape), dtype=np.uint8)
+        self.position = history_length - 1
+
+    # Fill the whole history of the given environments with one frame
+    def reset(self, frame, env=slice(None)):
+        self.buffer[env] = np.expand_dims(frame, -3)
+
+    def push(self, frames):
+        position = (self.position + 1) % self.history_length
+        self.buffer[:, position] = frames
+        self.buffer[:, position + self.history_length] = frames
+        self.position = position
+
+    @property
+    def stacked(self):
+        start = self.position + 1
+        return self.buffer[:, start:start + self.history_length]
@@ -0,0 +1,155 @@
+import json
+import os
+import queue
+import subprocess
+import threading
+
+import numpy as np
+
+POLICIES = ('every', 'best')
+
+
+class VideoRecorder(object):
+    """Gym wrapper that records sampled episodes to MP4 off the stepping path.
+
+    ``policy='every'`` records every ``every``-th episode; ``policy='best'``
+    records an episode only when its score beats every earlier episode,
+    which is only known once it ends, so every episode is buffered. Raw
+    frames are copied into one of two preallocated buffers of ``max_frames``
+    frames, and a writer thread pipes a finished episode to an ``ffmpeg``
+    process, which does the encoding. ``step`` never waits for it: frames
+    past ``max_frames`` are dropped, and an episode that starts while both
+    buffers are still being written is not recorded.
+
+    Videos and their ``.meta`` JSON are named like ``gym.wrappers.Monitor``
+    output, ``openaigym.video.0.<pid>.video<episode>.mp4``, with the score
+    and frame counts added to the meta file. An episode ends at the next
+    ``reset`` or at ``close``.
+    """
+
+    def __init__(self, env, directory, policy='every', every=1, max_frames=2000, fps=None):
+        if policy not in POLICIES:
+            raise ValueError('VideoRecorder: policy must be one of ' + ', '.join(POLICIES))
+        self.env = env
+        self.directory = directory
+        self.policy = policy
+        self.every = every
+        self.max_frames = max_frames
+        if fps is None:
+            fps = getattr(env, 'metadata', {}).get('video.frames_per_second', 30)
+        self.fps = fps
+
+        self.episode_id = -1
+        self.best_score = None
+        self.score = 0.0
+        self.frames = 0
+        self.frames_dropped = 0
+        self.episodes_dropped = 0
+        self.buffer = None
+        self.enabled = True
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._free = queue.Queue()
+        self._jobs = queue.Queue()
+        self._buffers_allocated = False
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def __getattr__(self, name):
+        return getattr(self.env, name)
+
+    def _wanted_now(self):
+        return self.policy == 'best' or self.episode_id % self.every == 0
+
+    def _start_episode(self, frame):
+        self._finish_episode()
+        self.episode_id += 1
+        self.score = 0.0
+        self.frames = 0
+        self.frames_dropped = 0
+        self.buffer = None
+        if not self.enabled or not self._wanted_now():
+            return
+        if not self._buffers_allocated:
+            for _ in range(2):
+                self._free.put(np.empty((self.max_frames,) + frame.shape, dtype=np.uint8))
+            self._buffers_allocated = True
+        try:
+            self.buffer = self._free.get_nowait()
+        except queue.Empty:
+            # The writer is behind; skip this episode rather than wait
+            self.episodes_dropped += 1
+
+    def _add_frame(self, frame):
+        if self.buffer is None:
+            return
+        if self.frames < self.max_frames:
+            self.buffer[self.frames] = frame
+            self.frames += 1
+        else:
+            self.frames_dropped += 1
+
+    def _finish_episode(self):
+        if self.buffer is None:
+            return
+        buffer, self.buffer = self.buffer, None
+        if self.policy == 'best':
+            if self.best_score is not None and self.score <= self.best_score:
+                self._free.put(buffer)
+                return
+            self.best_score = self.score
+        name = 'openaigym.video.0.%d.video%06d' % (os.getpid(), self.episode_id)
+        meta = {'episode_id': self.episode_id, 'content_type': 'video/mp4',
+                'score': self.score, 'frames': self.frames, 'frames_dropped': self.frames_dropped}
+        self._jobs.put((buffer, self.frames, os.path.join(self.directory, name), meta))
+
+    def reset(self, **kwargs):
+        observation = self.env.reset(**kwargs)
+        self._start_episode(observation)
+        self._add_frame(observation)
+        return observation
+
+    def step(self, action):
+        observation, reward, done, info = self.env.step(action)
+        self.score += reward
+        self._add_frame(observation)
+        return observation, reward, done, info
+
+    def _command(self, frame_shape, path):
+        height, width = frame_shape[:2]
+        return ['ffmpeg', '-nostats', '-loglevel', 'error', '-y',
+                '-f', 'rawvideo', '-s:v', '%dx%d' % (width, height), '-pix_fmt', 'rgb24',
+                '-framerate', str(self.fps), '-i', '-',
+                '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+                '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', path]
+
+    def _write_loop(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            buffer, frames, path, meta = job
+            command = self._command(buffer.shape[1:], path + '.mp4')
+            try:
+                process = subprocess.Popen(command, stdin=subprocess.PIPE)
+                process.stdin.write(buffer[:frames].data)
+                process.stdin.close()
+                # A failed encode leaves no usable video, so no meta is written for it
+                if process.wait() != 0:
+                    print('VideoRecorder: ffmpeg exited with status', process.returncode,
+                          'while encoding', path)
+                else:
+                    meta['encoder_version'] = {'backend': 'ffmpeg', 'cmdline': command}
+                    with open(path + '.meta', 'w') as f:
+                        json.dump(meta, f)
+            except OSError as e:
+                # Most likely no ffmpeg; training goes on without videos
+                print('VideoRecorder: encoding', path, 'failed, recording disabled:', e)
+                self.enabled = False
+            self._free.put(buffer)
+
+    def close(self):
+        self._finish_episode()
+        self._jobs.put(None)
+        self._writer.join()
+        self.env.close()
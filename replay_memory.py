@@ -0,0 +1,319 @@
+import numpy as np
+
+
+class ReplayMemory(object):
+    """Circular experience replay that stores every frame only once.
+
+    Slot ``i`` holds the newest frame of the state the agent acted on, plus
+    the action, clipped reward and terminal flag of that step. Stacked
+    states are rebuilt from frame indices when sampling: the state of slot
+    ``i`` is the frames of slots ``i - 3 .. i`` and its next state is the
+    state of slot ``i + 1``. Frames from before an episode start are
+    replaced by the first frame of the episode, which reproduces the
+    ``[obs, obs, obs, obs]`` stack the training loop builds on reset.
+
+    With the default 84x84 frames a 1,000,000 transition memory needs about
+    7.1 GB, instead of the ~56 GB used by storing both stacks per transition.
+
+    Transitions from ``num_envs`` parallel environments are appended together,
+    one slot per environment, so the previous and next frames of a slot are
+    ``num_envs`` slots away. The capacity is rounded down to a multiple of
+    ``num_envs``.
+
+    With ``frames_path`` the frames live in a ``.npy`` file mapped into
+    memory instead of in RAM, and only the pages in use stay resident. The
+    file is created empty on every run; it does not replace checkpoints.
+    """
+
+    def __init__(self, capacity, frame_shape=(84, 84), history_length=4, num_envs=1,
+                 frames_path=None):
+        self.num_envs = num_envs
+        self.capacity = capacity - capacity % num_envs
+        self.frame_shape = tuple(frame_shape)
+        self.history_length = history_length
+
+        if frames_path is None:
+            self.frames = np.zeros((self.capacity,) + self.frame_shape, dtype=np.uint8)
+        else:
+            self.frames = np.lib.format.open_memmap(frames_path, mode='w+', dtype=np.uint8,
+                                                    shape=(self.capacity,) + self.frame_shape)
+        self.actions = np.zeros(self.capacity, dtype=np.uint8)
+        self.rewards = np.zeros(self.capacity, dtype=np.float32)
+        self.terminals = np.zeros(self.capacity, dtype=np.bool_)
+        self.starts = np.zeros(self.capacity, dtype=np.bool_)
+
+        self.index = 0
+        self.size = 0
+        self.appended = 0
+
+    # A full memory over existing arrays, such as one shard of a recorded
+    # dataset; the arrays are used as they are, not copied
+    @classmethod
+    def from_arrays(cls, frames, actions, rewards, terminals, starts, history_length=4, num_envs=1):
+        if len(frames) % num_envs:
+            raise ValueError('ReplayMemory.from_arrays: %d rows are not a multiple of %d environments'
+                             % (len(frames), num_envs))
+        memory = cls(0, frame_shape=frames.shape[1:], history_length=history_length, num_envs=num_envs)
+        memory.frames = frames
+        memory.actions = actions
+        memory.rewards = rewards
+        memory.terminals = terminals
+        memory.starts = starts
+        memory.capacity = memory.size = memory.appended = len(frames)
+        return memory
+
+    def __len__(self):
+        return self.size
+
+    # With num_envs > 1 every argument holds one entry per environment
+    def append(self, frame, action, reward, terminate, start=False):
+        i, j = self.index, self.index + self.num_envs
+        self.frames[i:j] = frame
+        self.actions[i:j] = action
+        self.rewards[i:j] = reward
+        self.terminals[i:j] = terminate
+        self.starts[i:j] = start
+
+        self.index = j % self.capacity
+        self.size = min(self.size + self.num_envs, self.capacity)
+        self.appended += self.num_envs
+
+    @property
+    def oldest(self):
+        return (self.index - self.size) % self.capacity
+
+    def _stack_indices(self, idx):
+        # Walk back from each slot, repeating the slot itself once the
+        # episode start is reached so no frame leaks across episodes.
+        stack = np.empty((len(idx), self.history_length), dtype=np.int64)
+        stack[:, -1] = idx
+        for k in range(self.history_length - 2, -1, -1):
+            newer = stack[:, k + 1]
+            stack[:, k] = np.where(self.starts[newer], newer, (newer - self.num_envs) % self.capacity)
+        return stack
+
+    def _valid(self, idx):
+        # The oldest slots may have lost their history to overwrites, and the
+        # newest slots have no next state stored yet.
+        age = (idx - self.oldest) % self.capacity
+        nxt = (idx + self.num_envs) % self.capacity
+        has_next = (age < self.size - self.num_envs) & ~self.starts[nxt]
+        has_history = self._contiguous_history(idx, age)
+        return has_history & (self.terminals[idx] | has_next)
+
+    def _contiguous_history(self, idx, age):
+        # A slot whose episode began before the oldest stored slot cannot be
+        # rebuilt: its early frames have been overwritten.
+        ok = np.ones(len(idx), dtype=np.bool_)
+        reached_start = self.starts[idx].copy()
+        for k in range(1, self.history_length):
+            ok &= reached_start | (age >= k * self.num_envs)
+            reached_start |= self.starts[(idx - k * self.num_envs) % self.capacity]
+        return ok
+
+    def sample(self, batch_size):
+        if self.size < 2 * self.num_envs:
+            raise ValueError('ReplayMemory.sample: not enough transitions stored')
+
+        idx = np.empty(0, dtype=np.int64)
+        while len(idx) < batch_size:
+            candidates = (self.oldest + np.random.randint(0, self.size, size=2 * batch_size)) % self.capacity
+            idx = np.concatenate([idx, candidates[self._valid(candidates)]])
+        idx = idx[:batch_size]
+        return self.get(idx)
+
+    def get(self, idx):
+        idx = np.asarray(idx, dtype=np.int64)
+        terminate = self.terminals[idx]
+        # The next state of a terminal transition is never used by the
+        # Bellman target, so the state itself stands in for it.
+        next_idx = np.where(terminate, idx, (idx + self.num_envs) % self.capacity)
+        return {'state': self.frames[self._stack_indices(idx)],
+                'action': self.actions[idx].astype(np.int64),
+                'reward': self.rewards[idx],
+                'next': self.frames[self._stack_indices(next_idx)],
+                'terminate': terminate}
+
+    # Frames are returned without a copy so a checkpoint can stream them to
+    # disk; everything else is copied.
+    def get_state(self):
+        return {'frames': self.frames,
+                'actions': self.actions.copy(),
+                'rewards': self.rewards.copy(),
+                'terminals': self.terminals.copy(),
+                'starts': self.starts.copy(),
+                'index': self.index,
+                'size': self.size,
+                'appended': self.appended}
+
+    # dirty is the number of slots appended while the frames were being
+    # written; their frames are newer than the rest of the state, so the
+    # stored transitions they overlap are dropped.
+    def set_state(self, state, dirty=0):
+        if len(state['actions']) != self.capacity:
+            raise ValueError('ReplayMemory.set_state: capacity %d does not match %d'
+                             % (len(state['actions']), self.capacity))
+        self.frames[:] = state['frames']
+        self.actions[:] = state['actions']
+        self.rewards[:] = state['rewards']
+        self.terminals[:] = state['terminals']
+        self.starts[:] = state['starts']
+        self.index = int(state['index'])
+        self.appended = int(state['appended'])
+        self.size = max(0, int(state['size']) - max(0, int(state['size']) + dirty - self.capacity))
+
+
+class SumTree(object):
+    """Array-backed binary sum-tree over ``capacity`` non-negative priorities.
+
+    Node 1 is the root and the children of node ``n`` are ``2n`` and
+    ``2n + 1``; the leaves start at ``self.leaf_offset``. ``update`` and
+    ``find`` take whole batches of indices or values and walk the
+    ``log2(capacity)`` levels with one NumPy operation per level.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.leaf_offset = 1
+        while self.leaf_offset < capacity:
+            self.leaf_offset *= 2
+        self.depth = self.leaf_offset.bit_length() - 1
+        self.nodes = np.zeros(2 * self.leaf_offset, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.nodes[1]
+
+    @property
+    def priorities(self):
+        return self.nodes[self.leaf_offset:self.leaf_offset + self.capacity]
+
+    def __getitem__(self, idx):
+        return self.nodes[self.leaf_offset + np.asarray(idx, dtype=np.int64)]
+
+    def update(self, idx, priorities):
+        nodes = self.leaf_offset + np.asarray(idx, dtype=np.int64).ravel()
+        if len(nodes) == 0:
+            return
+        # With repeated indices the last priority wins, as with a plain loop
+        self.nodes[nodes] = priorities
+        # Duplicate parents just write the same sum twice
+        for _ in range(self.depth):
+            nodes //= 2
+            self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+
+    # Recomputes every inner node, after the leaves were written directly
+    def rebuild(self):
+        for level in range(self.depth - 1, -1, -1):
+            first, last = 2 ** level, 2 ** (level + 1)
+            self.nodes[first:last] = self.nodes[2 * first:2 * last:2] + self.nodes[2 * first + 1:2 * last:2]
+
+    # Leaf index of every value in [0, total), by prefix sum
+    def find(self, values):
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values >= self.nodes[left]
+            values -= np.where(go_right, self.nodes[left], 0)
+            nodes = left + go_right
+        # Rounding can land on an empty leaf right of the last priority
+        return np.minimum(nodes - self.leaf_offset, self.capacity - 1)
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """``ReplayMemory`` sampled proportionally to TD error (Schaul et al., 2016).
+
+    Slot ``i`` is drawn with probability ``p_i ** alpha / sum(p ** alpha)``,
+    using one stratified draw per batch element from a ``SumTree``. Slots
+    that cannot be sampled yet, because their next frame has not arrived,
+    keep priority zero; new transitions enter with the largest priority
+    seen so far. ``sample`` adds ``index`` and the importance-sampling
+    ``weight`` of every transition to the batch, normalized by the largest
+    weight in the batch; feed the new TD errors back with
+    ``update_priorities``. ``beta_at`` anneals the importance-sampling
+    exponent linearly from ``beta`` to 1 over ``beta_steps`` updates.
+    """
+
+    def __init__(self, capacity, frame_shape=(84, 84), history_length=4, num_envs=1,
+                 alpha=0.6, beta=0.4, beta_steps=250000, priority_epsilon=1e-6, frames_path=None):
+        super(PrioritizedReplayMemory, self).__init__(capacity, frame_shape, history_length, num_envs,
+                                                      frames_path=frames_path)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_steps = beta_steps
+        self.priority_epsilon = priority_epsilon
+        self.tree = SumTree(self.capacity)
+        self.max_priority = 1.0
+
+    def beta_at(self, step):
+        return self.beta + (1.0 - self.beta) * min(1.0, step / float(self.beta_steps))
+
+    def append(self, frame, action, reward, terminate, start=False):
+        i = self.index
+        stored = self.size
+        super(PrioritizedReplayMemory, self).append(frame, action, reward, terminate, start)
+        new = np.arange(i, i + self.num_envs)
+
+        # A terminal transition is complete as soon as it is stored; any other
+        # one waits for its next frame, which is what just arrived for the
+        # previous slot of each environment.
+        priorities = np.where(self.terminals[new], self.max_priority, 0.0)
+        previous = (new - self.num_envs) % self.capacity
+        completed = ~self.starts[new] & ~self.terminals[previous] if stored >= self.num_envs \
+            else np.zeros(self.num_envs, dtype=np.bool_)
+        self.tree.update(np.concatenate([new, previous[completed]]),
+                         np.concatenate([priorities, np.full(np.count_nonzero(completed), self.max_priority)]))
+
+    def sample(self, batch_size, beta=None):
+        if self.size < 2 * self.num_envs or self.tree.total <= 0:
+            raise ValueError('PrioritizedReplayMemory.sample: not enough transitions stored')
+        beta = self.beta if beta is None else beta
+
+        idx = np.empty(batch_size, dtype=np.int64)
+        missing = np.arange(batch_size)
+        while len(missing) > 0:
+            # Zeroing slots that turned out invalid can empty the whole tree
+            if self.tree.total <= 0:
+                raise ValueError('PrioritizedReplayMemory.sample: not enough transitions stored')
+            # One draw from each of batch_size equal slices of the total
+            segment = self.tree.total / batch_size
+            values = (missing + np.random.random(len(missing))) * segment
+            candidates = self.tree.find(values)
+            valid = self._valid(candidates) & (self.tree[candidates] > 0)
+            # Slots that lost their history to overwrites never become valid again
+            self.tree.update(candidates[~valid], 0.0)
+            idx[missing[valid]] = candidates[valid]
+            missing = missing[~valid]
+
+        probabilities = self.tree[idx] / self.tree.total
+        weights = (self.size * probabilities) ** -beta
+        batch = self.get(idx)
+        batch['index'] = idx
+        batch['weight'] = (weights / weights.max()).astype(np.float32)
+        return batch
+
+    def update_priorities(self, idx, td_errors):
+        priorities = (np.abs(td_errors) + self.priority_epsilon) ** self.alpha
+        self.max_priority = max(self.max_priority, float(np.max(priorities)))
+        self.tree.update(idx, priorities)
+
+    def get_state(self):
+        state = super(PrioritizedReplayMemory, self).get_state()
+        state['priorities'] = self.tree.priorities.copy()
+        state['max_priority'] = self.max_priority
+        return state
+
+    def set_state(self, state, dirty=0):
+        super(PrioritizedReplayMemory, self).set_state(state, dirty)
+        priorities = self.tree.priorities
+        if 'priorities' in state:
+            priorities[:] = state['priorities']
+            self.max_priority = float(state['max_priority'])
+        else:
+            # A uniform replay checkpoint: every stored transition starts equal
+            priorities[:] = self.max_priority
+        # Slots outside the stored range, including dropped dirty ones
+        age = (np.arange(self.capacity) - self.oldest) % self.capacity
+        priorities[age >= self.size] = 0.0
+        self.tree.rebuild()
@@ -0,0 +1,244 @@
+import collections
+import multiprocessing
+import queue
+
+import numpy as np
+
+
+class _Series(object):
+    # Growable 1-D array with amortized O(1) append
+    def __init__(self, dtype=np.float64, capacity=1024):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.size = 0
+
+    def append(self, value):
+        if self.size == len(self.data):
+            self.data = np.concatenate([self.data, np.zeros_like(self.data)])
+        self.data[self.size] = value
+        self.size += 1
+
+    @property
+    def values(self):
+        return self.data[:self.size]
+
+
+class EpisodeStatistics(object):
+    """Training and evaluation series, updated in O(1) per episode.
+
+    ``add_episode`` stores the score, epsilon and frame counter of a finished
+    episode and updates the running mean, min and max over the last
+    ``window`` episodes: the mean from a cumulative sum, min and max from
+    monotonic queues. The running mean of every episode is kept, so the
+    average plot needs no recomputation. ``add_evaluation`` stores one
+    evaluation result. Series are exposed as NumPy views.
+    """
+
+    def __init__(self, window=21):
+        self.window = window
+        self._scores = _Series()
+        self._epsilons = _Series(np.float32)
+        self._frames = _Series(np.int64)
+        self._running_avg = _Series()
+        self._cumsum = _Series()
+        self._cumsum.append(0.0)
+        self._min = collections.deque()
+        self._max = collections.deque()
+        self._evaluations = {name: _Series(np.int64 if name != 'score' else np.float64)
+                             for name in ('frame', 'episode', 't', 'score')}
+
+    def __len__(self):
+        return self._scores.size
+
+    def add_episode(self, score, epsilon, frame=0):
+        n = len(self)
+        self._scores.append(score)
+        self._epsilons.append(epsilon)
+        self._frames.append(frame)
+        self._cumsum.append(self._cumsum.data[n] + score)
+
+        first = max(0, n + 1 - self.window)
+        self._running_avg.append((self._cumsum.data[n + 1] - self._cumsum.data[first]) / (n + 1 - first))
+        for extremes, keep in ((self._min, np.less), (self._max, np.greater)):
+            while extremes and not keep(self._scores.data[extremes[-1]], score):
+                extremes.pop()
+            extremes.append(n)
+            if extremes[0] < first:
+                extremes.popleft()
+
+    def add_evaluation(self, frame, episode, t, score):
+        for name, value in (('frame', frame), ('episode', episode), ('t', t), ('score', score)):
+            self._evaluations[name].append(value)
+
+    @property
+    def scores(self):
+        return self._scores.values
+
+    @property
+    def epsilons(self):
+        return self._epsilons.values
+
+    @property
+    def frames(self):
+        return self._frames.values
+
+    @property
+    def running_avg(self):
+        return self._running_avg.values
+
+    @property
+    def rolling_mean(self):
+        return self.running_avg[-1]
+
+    @property
+    def rolling_min(self):
+        return self._scores.data[self._min[0]]
+
+    @property
+    def rolling_max(self):
+        return self._scores.data[self._max[0]]
+
+    def evaluations(self, name):
+        return self._evaluations[name].values
+
+    # Copies of every series, e.g. for ReportRenderer or export
+    def snapshot(self):
+        series = {'scores': self.scores, 'epsilons': self.epsilons, 'frames': self.frames,
+                  'running_avg': self.running_avg}
+        series.update(('eval_' + name, values.values) for name, values in self._evaluations.items())
+        return {name: values.copy() for name, values in series.items()}
+
+    def export(self, path):
+        np.savez(path, **self.snapshot())
+
+    # JSON friendly, for the checkpoint counters
+    def get_state(self):
+        return {name: values.tolist() for name, values in self.snapshot().items()
+                if name != 'running_avg'}
+
+    @classmethod
+    def from_state(cls, state, window=21):
+        statistics = cls(window)
+        for score, epsilon, frame in zip(state['scores'], state['epsilons'], state['frames']):
+            statistics.add_episode(score, epsilon, frame)
+        for row in zip(*(state['eval_' + name] for name in ('frame', 'episode', 't', 'score'))):
+            statistics.add_evaluation(*row)
+        return statistics
+
+
+def plot(x, y, z=None, mode=None, filename=None, running_avg=None):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111, label="1")
+    ax2 = fig.add_subplot(111, label="2", frame_on=False)
+
+    max_score = np.max(y)
+    min_score = np.min(y)
+    max_index = np.where(y == max_score)
+    min_index = np.where(y == min_score)
+
+    # ax | x = eps, yl = epsilon, bl
+    # ax | x = eps, yr = scores, yo
+    ax.plot(x, z, color="C0")
+    ax.set_xlabel("Game", color="C0")
+    ax.set_ylabel("Epsilon", color="C0")
+    ax.tick_params(axis='x', colors="C0")
+    ax.tick_params(axis='y', colors="C0")
+
+    if mode == 0:
+        # The Scores History Scatter Graph
+        print('train:', max_score, ' ', min_score)
+        print('train:', max_index, ' ', min_index)
+
+        max_score_str = 'Max Score=' + str(max_score)
+        min_score_str = 'Min Score=' + str(min_score)
+        ax2.text(0, max_score, max_score_str)
+        ax2.text(0, max_score - 300, min_score_str)
+        ax2.scatter(x, y, color="C1")
+    elif mode == 1:
+        # The Average Scores History Scatter Graph, running_avg comes from
+        # EpisodeStatistics
+        max_avg_score = np.max(running_avg)
+        min_avg_score = np.min(running_avg)
+        print('avg:', max_avg_score, ' ', min_avg_score)
+
+        max_avg_index = np.where(running_avg == max_avg_score)
+        min_avg_index = np.where(running_avg == min_avg_score)
+        print('avg:', max_avg_index, ' ', min_avg_index)
+
+        max_avg_score_str = 'Max Score=' + str(max_avg_score)
+        min_avg_score_str = 'Min Score=' + str(min_avg_score)
+        ax2.text(0, max_avg_score, max_avg_score_str)
+        ax2.text(0, max_avg_score - 80, min_avg_score_str)
+        ax2.scatter(x, running_avg, color="C1")
+
+    ax2.axes.get_xaxis().set_visible(False)
+    ax2.yaxis.tick_right()
+    ax2.set_ylabel('Score', color="C1")
+    ax2.yaxis.set_label_position('right')
+    ax2.tick_params(axis='y', colors="C1")
+
+    ax.set_title(filename)
+    if filename is not None:
+        fig.savefig(filename)
+    plt.close(fig)
+
+
+def _render_worker(tasks, export_path):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        episode_counter, series = task
+        episodes = np.arange(1, len(series['scores']) + 1)
+        for mode, name in ((0, 'train plot_'), (1, 'average plot_')):
+            try:
+                plot(episodes, series['scores'], series['epsilons'], mode,
+                     name + str(episode_counter), running_avg=series['running_avg'])
+            except Exception as e:
+                print(e)
+        if export_path is not None:
+            try:
+                np.savez(export_path, **series)
+            except Exception as e:
+                print(e)
+
+
+class ReportRenderer(object):
+    """Draws the train and average plots in a worker process.
+
+    ``submit`` hands a snapshot of an ``EpisodeStatistics`` to the worker,
+    which saves ``train plot_<episode>.png`` and ``average plot_<episode>.png``
+    with the Agg backend and, with ``export_path``, the series as ``.npz``.
+    Nothing is ever shown on screen. A report requested while the previous
+    one is still being drawn is skipped.
+    """
+
+    def __init__(self, export_path=None):
+        ctx = multiprocessing.get_context('spawn')
+        self.tasks = ctx.Queue(maxsize=1)
+        self.process = ctx.Process(target=_render_worker, args=(self.tasks, export_path), daemon=True)
+        self.process.start()
+
+    def submit(self, statistics, episode_counter):
+        if not self.process.is_alive():
+            print('Report skipped at episode', episode_counter, '- report worker has exited')
+            return False
+        try:
+            self.tasks.put_nowait((episode_counter, statistics.snapshot()))
+        except queue.Full:
+            print('Report skipped at episode', episode_counter, '- previous one still drawing')
+            return False
+        return True
+
+    # Waits for the queued report, then stops the worker if it is still running
+    def close(self):
+        while self.process.is_alive():
+            try:
+                self.tasks.put(None, timeout=1.0)
+                break
+            except queue.Full:
+                pass
+        self.process.join()
@@ -0,0 +1,313 @@
+"""Parallel hyperparameter sweeps of ``main.py train``.
+
+A sweep spec is a JSON file of hyperparameter names, as in ``--config``,
+mapped to the values to try:
+
+    {"grid": {"ALPHA": [0.00025, 0.0025], "GAMMA": [0.95, 0.99]},
+     "fixed": {"MAX_EPISODE": 2000, "NUM_ENVS": 4},
+     "seeds": [0, 1]}
+
+``grid`` runs every combination. ``random`` instead draws ``samples``
+configurations, each value a list to choose from or ``{"uniform": [a, b]}``
+/ ``{"log_uniform": [a, b]}``. Every configuration runs once per seed.
+
+Each run is a separate ``main.py train`` process in its own directory,
+``<output>/run_<n>``, holding its config, log, checkpoints, videos, plots
+and metrics. Runs are pinned to their own ``--cores-per-run`` cores, with
+the BLAS and TensorFlow thread pools sized to match, and as many run at
+once as there are core groups. Their metrics files are followed while they
+train and the latest row of every run is kept in ``<output>/results.csv``.
+
+With ``--stop-every``, a run is stopped once it reaches a multiple of that
+many frames with a running average score below the ``--stop-percentile``
+of what at least ``--stop-min-runs`` other runs scored at the same point.
+
+    python sweep.py sweep.json --output sweeps/alpha --cores-per-run 4
+"""
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import main as dqn
+
+# Thread pool sizes read by NumPy's BLAS, Keras and TensorFlow
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                    'TF_NUM_INTRAOP_THREADS')
+RESULT_COLUMNS = ('status', 'frames', 'episodes', 'updates', 'score_avg', 'frames_per_sec',
+                  'elapsed')
+
+
+def load_spec(path):
+    with open(path) as f:
+        spec = json.load(f)
+    names = {name for name, *_ in dqn.HYPERPARAMETERS}
+    for section in ('grid', 'random', 'fixed'):
+        unknown = {name.upper() for name in spec.get(section, {})} - names
+        if unknown:
+            raise ValueError('load_spec: unknown hyperparameters ' + ', '.join(sorted(unknown)))
+    if ('grid' in spec) == ('random' in spec):
+        raise ValueError('load_spec: give either grid or random')
+    return spec
+
+
+def _draw(values, rng):
+    if isinstance(values, list):
+        return rng.choice(values)
+    (kind, (low, high)), = values.items()
+    if kind == 'uniform':
+        return rng.uniform(low, high)
+    if kind == 'log_uniform':
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    raise ValueError('_draw: unknown distribution ' + kind)
+
+
+# Hyperparameter dicts, one per run, in launch order
+def expand(spec, seed=0):
+    if 'grid' in spec:
+        names = sorted(spec['grid'])
+        configs = [dict(zip(names, values))
+                   for values in itertools.product(*(spec['grid'][name] for name in names))]
+    else:
+        rng = random.Random(seed)
+        configs = [{name: _draw(values, rng) for name, values in sorted(spec['random'].items())}
+                   for _ in range(spec.get('samples', 10))]
+
+    runs = []
+    for config in configs:
+        for run_seed in spec.get('seeds', [None]):
+            run = {name.upper(): value for name, value in spec.get('fixed', {}).items()}
+            run.update((name.upper(), value) for name, value in config.items())
+            # Without seeds, a SEED in fixed or the grid is kept
+            if 'seeds' in spec:
+                run['SEED'] = run_seed
+            runs.append(run)
+    return runs
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class Run(object):
+    # One training process and the metrics read from it so far
+    def __init__(self, index, params, directory):
+        self.index = index
+        self.params = params
+        self.directory = directory
+        self.process = None
+        self.cores = None
+        self.status = 'pending'
+        self.started = None
+        self.finished = None
+        self.row = {}
+        self.milestones = {}
+        self._offset = 0
+        self._partial = ''
+
+    def start(self, cores):
+        os.makedirs(self.directory, exist_ok=True)
+        config = dict(self.params, CHECKPOINT_DIR='checkpoints', VIDEO_DIR='videos',
+                      STATISTICS_PATH='statistics.npz', METRICS=True, METRICS_PATH='metrics.jsonl')
+        with open(os.path.join(self.directory, 'config.json'), 'w') as f:
+            json.dump(config, f, indent=2)
+
+        env = dict(os.environ, MPLBACKEND='Agg', TF_NUM_INTEROP_THREADS='1')
+        env.update((name, str(len(cores))) for name in THREAD_VARIABLES)
+        # The environment and evaluation workers inherit the pinning
+        pin = (lambda: os.sched_setaffinity(0, cores)) if hasattr(os, 'sched_setaffinity') else None
+        command = [sys.executable, os.path.abspath(dqn.__file__), 'train', '--config', 'config.json']
+        log = open(os.path.join(self.directory, 'train.log'), 'w')
+        # A session of its own, so stop can signal the workers as well
+        self.process = subprocess.Popen(command, cwd=self.directory, env=env, stdout=log,
+                                        stderr=subprocess.STDOUT, preexec_fn=pin,
+                                        start_new_session=True)
+        log.close()
+        self.cores = cores
+        self.status = 'running'
+        self.started = time.time()
+
+    # Reads the metrics rows written since the last call
+    def poll_metrics(self):
+        path = os.path.join(self.directory, 'metrics.jsonl')
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            f.seek(self._offset)
+            text = self._partial + f.read()
+            self._offset = f.tell()
+        lines = text.split('\n')
+        # The last line is still being written unless the text ends in a newline
+        self._partial = lines.pop()
+        for line in lines:
+            if line:
+                self.row = json.loads(line)
+
+    def poll(self):
+        self.poll_metrics()
+        if self.status == 'running' and self.process.poll() is not None:
+            self.status = 'finished' if self.process.returncode == 0 else \
+                'failed (%d)' % self.process.returncode
+            self.finished = time.time()
+        return self.status != 'running'
+
+    def stop(self, reason='stopped'):
+        if self.process is not None and self.process.poll() is None:
+            if hasattr(os, 'killpg'):
+                os.killpg(self.process.pid, signal.SIGTERM)
+            else:
+                self.process.terminate()
+            try:
+                self.process.wait(30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.status = reason
+        self.finished = time.time()
+
+    def result(self):
+        end = self.finished or time.time()
+        return {'status': self.status,
+                'frames': self.row.get('frames', 0),
+                'episodes': self.row.get('episodes', 0),
+                'updates': self.row.get('updates', 0),
+                'score_avg': self.row.get('score_avg', ''),
+                'frames_per_sec': self.row.get('frames_per_sec', ''),
+                'elapsed': round(end - self.started, 1) if self.started else 0}
+
+
+class Sweep(object):
+    """Runs every configuration of a spec, ``parallel`` at a time.
+
+    ``poll`` starts pending runs on free core groups, reads new metrics,
+    applies early stopping and rewrites ``results.csv``; ``run`` calls it
+    every ``poll_seconds`` until every run is done.
+    """
+
+    def __init__(self, runs, output, cores_per_run=4, parallel=None, stop_every=0,
+                 stop_percentile=25, stop_min_runs=4, poll_seconds=10):
+        cores = available_cores()
+        cores_per_run = min(cores_per_run, len(cores))
+        groups = [cores[i:i + cores_per_run]
+                  for i in range(0, len(cores) - cores_per_run + 1, cores_per_run)]
+        if parallel is not None:
+            groups = groups[:parallel]
+        self.free = groups
+        self.output = output
+        self.stop_every = stop_every
+        self.stop_percentile = stop_percentile
+        self.stop_min_runs = stop_min_runs
+        self.poll_seconds = poll_seconds
+        self.runs = [Run(i, params, os.path.join(output, 'run_%03d' % i))
+                     for i, params in enumerate(runs)]
+        self.names = sorted({name for params in runs for name in params})
+        os.makedirs(output, exist_ok=True)
+
+    def _early_stop(self, run):
+        # Score at each stop_every frames milestone, compared to the others
+        frames, score = run.row.get('frames', 0), run.row.get('score_avg')
+        if score is None or frames < self.stop_every:
+            return
+        milestone = frames // self.stop_every * self.stop_every
+        if milestone in run.milestones:
+            return
+        run.milestones[milestone] = score
+        others = [other.milestones[milestone] for other in self.runs
+                  if other is not run and milestone in other.milestones]
+        if len(others) >= self.stop_min_runs and \
+                score < np.percentile(others, self.stop_percentile):
+            print('Sweep: stopping run', run.index, 'at', milestone, 'frames, score', score)
+            self._release(run)
+            run.stop('stopped early')
+
+    def _release(self, run):
+        if run.cores is not None:
+            self.free.append(run.cores)
+            run.cores = None
+
+    def poll(self):
+        for run in self.runs:
+            if run.status == 'running':
+                if run.poll():
+                    self._release(run)
+                    print('Sweep: run', run.index, run.status)
+                elif self.stop_every:
+                    self._early_stop(run)
+        for run in self.runs:
+            if run.status == 'pending' and self.free:
+                run.start(self.free.pop(0))
+                print('Sweep: run', run.index, 'started on cores', run.cores, run.params)
+        self.write_results()
+        return all(run.status not in ('pending', 'running') for run in self.runs)
+
+    def write_results(self):
+        path = os.path.join(self.output, 'results.csv')
+        with open(path + '.tmp', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['run'] + self.names + list(RESULT_COLUMNS))
+            for run in self.runs:
+                result = run.result()
+                writer.writerow([run.index] + [run.params.get(name, '') for name in self.names] +
+                                [result[name] for name in RESULT_COLUMNS])
+        os.replace(path + '.tmp', path)
+
+    def run(self):
+        if not self.free:
+            raise ValueError('Sweep.run: no cores to run on')
+        try:
+            while not self.poll():
+                time.sleep(self.poll_seconds)
+        finally:
+            for run in self.runs:
+                if run.status == 'running':
+                    run.stop('interrupted')
+            self.write_results()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('spec', help='JSON sweep spec')
+    parser.add_argument('--output', default='./sweeps', help='directory of the runs and results.csv')
+    parser.add_argument('--cores-per-run', type=int, default=4,
+                        help='cores pinned to each run, default 4')
+    parser.add_argument('--parallel', type=int,
+                        help='runs at once, default as many as there are core groups')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random search')
+    parser.add_argument('--stop-every', type=int, default=0,
+                        help='frames between early stopping checks, default 0 (never)')
+    parser.add_argument('--stop-percentile', type=float, default=25,
+                        help='stop runs scoring below this percentile of the others, default 25')
+    parser.add_argument('--stop-min-runs', type=int, default=4,
+                        help='other runs needed at a milestone before stopping, default 4')
+    parser.add_argument('--poll-seconds', type=float, default=10)
+    parser.add_argument('--dry-run', action='store_true', help='print the runs and exit')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    runs = expand(load_spec(args.spec), seed=args.seed)
+    if args.dry_run:
+        for i, params in enumerate(runs):
+            print(i, json.dumps(params))
+        return
+    sweep = Sweep(runs, args.output, cores_per_run=args.cores_per_run, parallel=args.parallel,
+                  stop_every=args.stop_every, stop_percentile=args.stop_percentile,
+                  stop_min_runs=args.stop_min_runs, poll_seconds=args.poll_seconds)
+    sweep.run()
+    print('Results in', os.path.join(args.output, 'results.csv'))
+
+
+if __name__ == '__main__':
+    main()
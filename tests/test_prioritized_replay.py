@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from replay_memory import PrioritizedReplayMemory, SumTree
+
+
+@pytest.mark.parametrize('capacity', [1, 5, 8, 37])
+def test_find_matches_cumulative_sum(capacity):
+    rng = np.random.RandomState(capacity)
+    tree = SumTree(capacity)
+    priorities = rng.random_sample(capacity)
+    priorities[rng.random_sample(capacity) < 0.3] = 0.0
+    priorities[-1] = 0.5
+    tree.update(np.arange(capacity), priorities)
+
+    cumulative = np.cumsum(priorities)
+    np.testing.assert_allclose(tree.total, cumulative[-1])
+    # The leaf holding value v is the first one whose cumulative sum exceeds v;
+    # values exactly on a boundary may round either way, so none are used
+    values = rng.random_sample(200) * tree.total
+    np.testing.assert_array_equal(tree.find(values), np.searchsorted(cumulative, values, side='right'))
+    # The middle of every leaf's slice, empty leaves are never found
+    nonzero = np.flatnonzero(priorities)
+    np.testing.assert_array_equal(tree.find(cumulative[nonzero] - priorities[nonzero] / 2), nonzero)
+
+
+def test_update_with_duplicate_indices_keeps_the_last():
+    tree = SumTree(10)
+    tree.update([3, 7, 3, 3], [1.0, 2.0, 4.0, 8.0])
+    np.testing.assert_array_equal(tree[[3, 7]], [8.0, 2.0])
+    assert tree.total == 10.0
+
+    tree.update([7, 7], [0.0, 0.5])
+    assert tree.total == 8.5
+
+
+def test_rebuild_matches_update():
+    rng = np.random.RandomState(0)
+    priorities = rng.random_sample(23)
+    updated = SumTree(23)
+    updated.update(np.arange(23), priorities)
+
+    rebuilt = SumTree(23)
+    rebuilt.priorities[:] = priorities
+    rebuilt.rebuild()
+    np.testing.assert_allclose(rebuilt.nodes, updated.nodes)
+
+
+def expected_priorities(memory, terminals):
+    # Terminal slots count at once, others once their next frame is stored
+    appended = memory.appended
+    expected = np.zeros(memory.capacity, dtype=np.bool_)
+    for row in range(appended - memory.size, appended):
+        expected[row % memory.capacity] = terminals[row] or row + memory.num_envs < appended
+    return expected
+
+
+@pytest.mark.parametrize('num_envs', [1, 4])
+def test_append_gives_completed_slots_the_max_priority(num_envs):
+    rng = np.random.RandomState(num_envs)
+    memory = PrioritizedReplayMemory(48, frame_shape=(2,), num_envs=num_envs)
+    frames = np.zeros((num_envs, 2), dtype=np.uint8)
+    new_episode = np.ones(num_envs, dtype=np.bool_)
+    terminals = []
+
+    def tick():
+        terminate = rng.random_sample(num_envs) < 0.2
+        memory.append(frames, 0, 0.0, terminate, start=new_episode.copy())
+        new_episode[:] = terminate
+        terminals.extend(terminate)
+
+    for _ in range(30):
+        tick()
+        expected = expected_priorities(memory, terminals)
+        np.testing.assert_array_equal(memory.tree.priorities > 0, expected)
+        np.testing.assert_array_equal(memory.tree.priorities[expected], 1.0)
+    np.testing.assert_allclose(memory.tree.total, memory.tree.priorities.sum())
+
+    # A larger TD error raises the priority new transitions enter with
+    stored = np.flatnonzero(memory.tree.priorities)
+    memory.update_priorities(stored[:1], np.array([10.0]))
+    assert memory.max_priority == pytest.approx((10.0 + memory.priority_epsilon) ** memory.alpha)
+    before = memory.tree.priorities.copy()
+    tick()
+    changed = memory.tree.priorities != before
+    newly = changed & (memory.tree.priorities > 0)
+    assert np.any(newly)
+    np.testing.assert_allclose(memory.tree.priorities[newly], memory.max_priority)
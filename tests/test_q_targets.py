@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+from main import DeepQNetwork
+
+# Batched and batch-1 convolutions sum in a different order, so the two paths
+# agree to float32 rounding only: about 3e-4 on Q values around 300.
+RTOL = 1e-5
+ATOL = 1e-3
+
+
+def make_batch(rng, batch_size=16, input_dims=(4, 84, 84), total_action=6):
+    terminate = np.zeros(batch_size, dtype=np.bool_)
+    terminate[::3] = True
+    return {'state': rng.integers(0, 256, (batch_size,) + input_dims, dtype=np.uint8),
+            'next': rng.integers(0, 256, (batch_size,) + input_dims, dtype=np.uint8),
+            'action': rng.integers(0, total_action, batch_size),
+            'reward': rng.choice(np.array([-1, 0, 1], dtype=np.float32), batch_size),
+            'terminate': terminate}
+
+
+def test_batched_targets_match_per_sample_targets():
+    rng = np.random.default_rng(0)
+    networks = DeepQNetwork(6, input_dimension=(4, 84, 84), discount_factor=0.95)
+    batch = make_batch(rng)
+
+    s_batched, q_batched, td_batched = networks.q_targets(batch, networks.target_model)
+    s_single, q_single, td_single = networks.per_sample_q_targets(batch, networks.target_model)
+
+    np.testing.assert_array_equal(s_batched, s_single)
+    np.testing.assert_allclose(q_batched, q_single, rtol=RTOL, atol=ATOL)
+    np.testing.assert_allclose(td_batched, td_single, rtol=RTOL, atol=ATOL)
+
+    # Terminal rows are the reward alone, whatever the target network says
+    rows = np.flatnonzero(batch['terminate'])
+    np.testing.assert_array_equal(q_batched[rows, batch['action'][rows]], batch['reward'][rows])
+    np.testing.assert_array_equal(q_single[rows, batch['action'][rows]], batch['reward'][rows])
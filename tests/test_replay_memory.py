@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+
+from replay_memory import ReplayMemory
+
+HISTORY = 4
+
+
+def decode(frames):
+    # Frames are two bytes holding a frame id
+    return frames[..., 0].astype(np.int64) * 256 + frames[..., 1]
+
+
+def encode(frame_id):
+    return np.array([frame_id // 256, frame_id % 256], dtype=np.uint8)
+
+
+def play(memory, ticks, seed, terminal_rate=0.15, first_id=0):
+    """Appends ``ticks`` steps of every environment, as the training loop does.
+
+    Each environment keeps its stack naively, ``[obs] * 4`` on reset and
+    shifted by one frame per step. Returns, for every appended row, the
+    frame ids of its state and next state, whether it is terminal, and the
+    oldest row any of those frames was stored in.
+    """
+    rng = np.random.RandomState(seed)
+    num_envs = memory.num_envs
+    next_id = first_id
+    stacks = []
+    for _ in range(num_envs):
+        stacks.append([next_id] * HISTORY)
+        next_id += 1
+    new_episode = np.ones(num_envs, dtype=np.bool_)
+    row_of = {}
+    rows = []
+
+    for _ in range(ticks):
+        frames = np.array([encode(stack[-1]) for stack in stacks])
+        terminals = rng.random_sample(num_envs) < terminal_rate
+        for env in range(num_envs):
+            row_of[stacks[env][-1]] = len(rows)
+            state = list(stacks[env])
+            if terminals[env]:
+                stacks[env] = [next_id] * HISTORY
+                following = state
+            else:
+                stacks[env] = state[1:] + [next_id]
+                following = stacks[env]
+            next_id += 1
+            rows.append({'state': state, 'next': following, 'terminal': terminals[env],
+                         'first_row': min(row_of[frame_id] for frame_id in state)})
+        memory.append(frames, np.arange(num_envs), np.ones(num_envs), terminals, start=new_episode)
+        new_episode = terminals.copy()
+    return rows
+
+
+def expected_valid(rows, appended, size, num_envs):
+    # Every frame still stored, and the next frame too unless the row is terminal
+    oldest = appended - size
+    return {row for row in range(oldest, appended)
+            if rows[row]['first_row'] >= oldest and
+            (rows[row]['terminal'] or row + num_envs < appended)}
+
+
+@pytest.mark.parametrize('num_envs', [1, 3])
+@pytest.mark.parametrize('ticks', [5, 20, 97])
+def test_get_matches_naive_stacks(num_envs, ticks):
+    memory = ReplayMemory(60, frame_shape=(2,), history_length=HISTORY, num_envs=num_envs)
+    rows = play(memory, ticks, seed=ticks + num_envs)
+    appended = len(rows)
+    assert memory.appended == appended
+
+    valid = expected_valid(rows, appended, memory.size, num_envs)
+    stored = np.arange(appended - memory.size, appended)
+    slots = stored % memory.capacity
+    np.testing.assert_array_equal(memory._valid(slots), [row in valid for row in stored])
+
+    valid = sorted(valid)
+    batch = memory.get(np.array(valid) % memory.capacity)
+    np.testing.assert_array_equal(decode(batch['state']), [rows[row]['state'] for row in valid])
+    np.testing.assert_array_equal(decode(batch['next']), [rows[row]['next'] for row in valid])
+    np.testing.assert_array_equal(batch['terminate'], [rows[row]['terminal'] for row in valid])
+
+
+@pytest.mark.parametrize('num_envs', [1, 3])
+def test_sample_never_returns_lost_history(num_envs):
+    np.random.seed(0)
+    memory = ReplayMemory(60, frame_shape=(2,), history_length=HISTORY, num_envs=num_envs)
+    rows = play(memory, 200, seed=num_envs)
+    valid = expected_valid(rows, len(rows), memory.size, num_envs)
+    pairs = {(tuple(rows[row]['state']), tuple(rows[row]['next'])) for row in valid}
+
+    batch = memory.sample(2000)
+    for state, following in zip(decode(batch['state']), decode(batch['next'])):
+        assert (tuple(state), tuple(following)) in pairs
+
+
+@pytest.mark.parametrize('dirty', [0, 2, 5])
+def test_set_state_drops_slots_written_during_save(dirty):
+    num_envs = 2
+    memory = ReplayMemory(40, frame_shape=(2,), history_length=HISTORY, num_envs=num_envs)
+    rows = play(memory, 50, seed=dirty)
+    state = memory.get_state()
+    appended, size = memory.appended, memory.size
+
+    # The frames are not copied, so slots appended meanwhile overwrite them
+    play(memory, dirty, seed=dirty + 1, first_id=10000)
+    restored = ReplayMemory(40, frame_shape=(2,), history_length=HISTORY, num_envs=num_envs)
+    restored.set_state(state, dirty=dirty * num_envs)
+    assert restored.size == size - dirty * num_envs
+
+    valid = expected_valid(rows, appended, restored.size, num_envs)
+    stored = np.arange(appended - restored.size, appended)
+    np.testing.assert_array_equal(restored._valid(stored % restored.capacity),
+                                  [row in valid for row in stored])
+    valid = sorted(valid)
+    batch = restored.get(np.array(valid) % restored.capacity)
+    np.testing.assert_array_equal(decode(batch['state']), [rows[row]['state'] for row in valid])
+    np.testing.assert_array_equal(decode(batch['next']), [rows[row]['next'] for row in valid])
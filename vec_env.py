@@ -0,0 +1,141 @@
+import ctypes
+import multiprocessing
+
+import numpy as np
+
+from preprocessing import FrameStacker
+from recording import VideoRecorder
+
+
+def _worker(remote, parent_remote, env_id, index, num_envs, preprocess,
+            buffers, frame_shape, history_length, video, seed):
+    parent_remote.close()
+    if callable(env_id):
+        env = env_id()
+    else:
+        import gym
+        env = gym.make(env_id)
+    if seed is not None and hasattr(env, 'seed'):
+        env.seed(seed + index)
+    if video is not None and index == 0:
+        env = VideoRecorder(env, **video)
+
+    shape = (num_envs, history_length) + frame_shape
+    views = [np.frombuffer(buf, dtype=np.uint8).reshape(shape)[index] for buf in buffers]
+    stacker = FrameStacker(history_length=history_length, frame_shape=frame_shape)
+    frame = np.empty(frame_shape, dtype=np.uint8)
+
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                action, slot = data
+                observation, reward, done, info = env.step(action)
+                if done:
+                    # Start the next episode right away; the terminal frame
+                    # is never needed since its Bellman target is masked.
+                    stacker.reset(preprocess(env.reset(), out=frame))
+                else:
+                    stacker.push(preprocess(observation, out=frame))
+                views[slot][:] = stacker.stacked[0]
+                remote.send((reward, done, info))
+            elif cmd == 'reset':
+                stacker.reset(preprocess(env.reset(), out=frame))
+                views[data][:] = stacker.stacked[0]
+                remote.send(None)
+            elif cmd == 'spaces':
+                remote.send((env.action_space.n, env.unwrapped.get_action_meanings(),
+                             env.observation_space.shape))
+            elif cmd == 'close':
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env.close()
+        remote.close()
+
+
+class SubprocVecEnv(object):
+    """Runs ``num_envs`` copies of a gym environment in worker processes.
+
+    Every worker preprocesses its frames with ``preprocess(observation,
+    out=frame)``, which must be picklable, keeps its own ``FrameStacker`` and
+    writes the stacked ``uint8`` observation straight into shared memory.
+    ``reset`` and ``step`` return a ``(num_envs, history_length, *frame_shape)``
+    view of that memory. Two buffers are used in turn, so the array returned
+    by one call stays valid until the call after next; copy it to keep it
+    longer.
+
+    ``env_id`` is a gym id, or a picklable callable that builds the
+    environment in the worker, such as ``SyntheticAtariEnv``. ``video`` holds
+    the keyword arguments of a ``VideoRecorder`` for the first worker's
+    environment; the other workers never record. With ``seed``, worker ``i``
+    seeds its environment with ``seed + i``.
+
+    Episodes restart automatically when an environment reports ``done``; the
+    observation returned for that environment is then the first state of the
+    next episode.
+    """
+
+    def __init__(self, env_id, num_envs, preprocess, frame_shape=(84, 84),
+                 history_length=4, video=None, seed=None):
+        self.num_envs = num_envs
+        self.frame_shape = tuple(frame_shape)
+        self.history_length = history_length
+
+        ctx = multiprocessing.get_context('spawn')
+        shape = (num_envs, history_length) + self.frame_shape
+        self._buffers = [ctx.RawArray(ctypes.c_uint8, int(np.prod(shape))) for _ in range(2)]
+        self._views = [np.frombuffer(buf, dtype=np.uint8).reshape(shape) for buf in self._buffers]
+        self._slot = 0
+
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(num_envs)])
+        self.processes = []
+        for index, (work_remote, remote) in enumerate(zip(self.work_remotes, self.remotes)):
+            process = ctx.Process(target=_worker,
+                                  args=(work_remote, remote, env_id, index, num_envs, preprocess,
+                                        self._buffers, self.frame_shape, history_length, video, seed),
+                                  daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+        self.remotes[0].send(('spaces', None))
+        self.total_action, self.action_meanings, self.observation_shape = self.remotes[0].recv()
+        self.closed = False
+
+    def _next_slot(self):
+        self._slot ^= 1
+        return self._slot
+
+    def reset(self):
+        slot = self._next_slot()
+        for remote in self.remotes:
+            remote.send(('reset', slot))
+        for remote in self.remotes:
+            remote.recv()
+        return self._views[slot]
+
+    def step_async(self, actions):
+        slot = self._next_slot()
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', (int(action), slot)))
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        rewards, dones, infos = zip(*results)
+        return (self._views[self._slot], np.asarray(rewards, dtype=np.float32),
+                np.asarray(dones, dtype=np.bool_), list(infos))
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.closed = True